@@ -0,0 +1,363 @@
+"""
+Offline benchmark of detect-only runs, full converges and no-op re-runs.
+Commands run against FakeBackend, a scripted system with simulated dpkg, flatpak, snap and pip
+inventories and a configurable latency per command, on synthetic State trees of any size.
+
+    python bench.py --states 2000 --repeat 3
+    python bench.py --states 5000 --latency 'apt install=0.5' --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+from lib import *
+from unix import *
+
+
+# seconds per command, looked up by program and subcommand, then by program
+DEFAULT_LATENCY = {
+    'dpkg-query': 0.05,
+    'apt install': 0.05,
+    'apt remove': 0.05,
+    'apt update': 0.5,
+    'dpkg': 0.05,
+    'flatpak list': 0.02,
+    'flatpak remotes': 0.01,
+    'flatpak': 0.05,
+    'snap list': 0.02,
+    'snap': 0.05,
+    'pip list': 0.1,
+    'pip': 0.02,
+    'add-apt-repository': 0.02,
+    'test': 0.002,
+}
+
+
+class FakeBackend(Backend):
+    """
+    Executes the commands of Shell.run against an in-memory system instead of the real one.
+    Understands the commands of the package manager States and the file commands used in Command states.
+    """
+    def __init__(self, latency: dict[str, float] = None, default_latency: float = 0.001):
+        """
+        latency: seconds per command keyed by 'program subcommand' or 'program'
+        default_latency: seconds for commands without an entry in latency
+        """
+        self.latency = DEFAULT_LATENCY if latency is None else latency
+        self.default_latency = default_latency
+        self.debs = set()
+        self.flatpaks = set()
+        self.remotes = set()
+        self.snaps = set()
+        self.pips = set()
+        self.repositories = set()
+        self.files = {}
+        self.commands = 0
+        self._lock = threading.Lock()
+
+    def _delay(self, argv: list[str]) -> float:
+        if len(argv) > 1 and f"{argv[0]} {argv[1]}" in self.latency:
+            return self.latency[f"{argv[0]} {argv[1]}"]
+        return self.latency.get(argv[0], self.default_latency) if argv else 0.0
+
+    @staticmethod
+    def _split(cmd: str) -> tuple[list[str], str | None]:
+        # only 'command | grep pattern' pipes are used by the States
+        cmd, _, grep = cmd.partition(' | grep ')
+        argv = shlex.split(cmd)
+        if argv[:1] == ['sudo']:
+            argv = argv[1:]
+        return argv, shlex.split(grep)[0] if grep else None
+
+    def execute(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        argv, grep = self._split(cmd)
+        time.sleep(self._delay(argv))
+        return self._result(cmd, argv, grep, output)
+
+    async def execute_async(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        argv, grep = self._split(cmd)
+        await asyncio.sleep(self._delay(argv))
+        return self._result(cmd, argv, grep, output)
+
+    def _result(self, cmd: str, argv: list[str], grep: str | None, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        with self._lock:
+            self.commands += 1
+            code, stdout = self._execute(argv)
+        stderr = b''
+        if code == 127:
+            stderr = f"{argv[0]}: command not found\n".encode()
+        if grep is not None:
+            lines = [line for line in stdout.splitlines() if re.search(grep, line)]
+            stdout = ''.join(f"{line}\n" for line in lines)
+            code = 0 if lines else 1
+        if output is not None:
+            output.write(1, stdout.encode())
+            output.write(2, stderr)
+            return output.result(code)
+        return subprocess.CompletedProcess(cmd, code, stdout.encode(), stderr)
+
+    def _execute(self, argv: list[str]) -> tuple[int, str]:
+        """
+        Returns exit code and stdout of argv, changing the fake system.
+        """
+        args = [a for a in argv[1:] if not a.startswith('-')]
+        flags = [a for a in argv[1:] if a.startswith('-')]
+        match argv:
+            case ['true']:
+                return 0, ''
+            case ['false']:
+                return 1, ''
+            case ['dpkg-query', *_]:
+                return 0, ''.join(f"{deb} install ok installed\n" for deb in sorted(self.debs))
+            case ['apt', 'update', *_]:
+                return 0, ''
+            case ['apt', 'install', *_]:
+                self.debs.update(args[1:])
+                return 0, ''
+            case ['apt', 'remove', *_]:
+                self.debs.difference_update(args[1:])
+                return 0, ''
+            case ['dpkg', '--install', archive]:
+                self.debs.add(os.path.basename(archive).removesuffix('.deb'))
+                return 0, ''
+            case ['dpkg', '--remove', package]:
+                self.debs.discard(package)
+                return 0, ''
+            case ['flatpak', 'list', *_]:
+                return 0, ''.join(f"{app}\t{scope}\n" for app, scope in sorted(self.flatpaks))
+            case ['flatpak', 'install', *_]:
+                scope = 'system' if '--system' in flags else 'user'
+                self.flatpaks.update((app, scope) for app in args[2:])
+                return 0, ''
+            case ['flatpak', 'uninstall', *_]:
+                self.flatpaks = {(app, scope) for app, scope in self.flatpaks if app not in args[1:]}
+                return 0, ''
+            case ['flatpak', 'remotes', *_]:
+                return 0, ''.join(f"{name}\t{scope}\n" for name, scope in sorted(self.remotes))
+            case ['flatpak', 'remote-add', *_]:
+                self.remotes.add((args[1], 'system' if '--system' in flags else 'user'))
+                return 0, ''
+            case ['flatpak', 'remote-delete', name]:
+                self.remotes = {remote for remote in self.remotes if remote[0] != name}
+                return 0, ''
+            case ['snap', 'list']:
+                return 0, 'Name  Version  Rev  Tracking  Publisher  Notes\n' + ''.join(f"{snap}  1.0  1  latest/stable  fake  -\n" for snap in sorted(self.snaps))
+            case ['snap', 'install', *_]:
+                self.snaps.update(args[1:])
+                return 0, ''
+            case ['snap', 'remove', *_]:
+                self.snaps.difference_update(args[1:])
+                return 0, ''
+            case ['pip', 'list', *_]:
+                return 0, json.dumps([{'name': name, 'version': '1.0'} for name in sorted(self.pips)])
+            case ['pip', 'install', *_]:
+                self.pips.update(PipInventory.normalize(name) for name in args[1:])
+                return 0, ''
+            case ['pip', 'uninstall', *_]:
+                self.pips.difference_update(PipInventory.normalize(name) for name in args[1:])
+                return 0, ''
+            case ['add-apt-repository', '--list']:
+                return 0, ''.join(f"deb {ppa}\n" for ppa in sorted(self.repositories))
+            case ['add-apt-repository', *_]:
+                if '--remove' in flags:
+                    self.repositories.difference_update(args)
+                else:
+                    self.repositories.update(args)
+                return 0, ''
+            case ['test', '-f' | '-d' | '-L' as kind, path]:
+                return (0 if self.files.get(path) == kind else 1), ''
+            case ['touch', path]:
+                self.files[path] = '-f'
+                return 0, ''
+            case ['mkdir', '-p', path]:
+                self.files[path] = '-d'
+                return 0, ''
+            case ['ln', '-s', _, path]:
+                self.files[path] = '-L'
+                return 0, ''
+            case ['rm', *_]:
+                for path in args:
+                    self.files.pop(path, None)
+                return 0, ''
+        return 127, ''
+
+
+def synthetic(size: int, seed: int = 0) -> State:
+    """
+    Returns a reproducible config of about size leaf States, split into sections like my_ubuntu.py.
+    """
+    rng = random.Random(seed)
+    base = Chain(
+            Apt('flatpak'),
+            Apt('snapd'),
+            Apt('python3-pip'),
+            AddFlatpakRemote('flathub', 'https://dl.flathub.org/repo/flathub.flatpakrepo'),
+            AddAptRepository('ppa:bench/tools'),
+        )
+    sections = []
+    count = 0
+    while count < size:
+        states = []
+        for _ in range(min(rng.randint(5, 50), size - count)):
+            kind = rng.choices(('apt', 'flatpak', 'snap', 'pip', 'file', 'dir', 'link'), weights=(50, 8, 4, 12, 12, 8, 6))[0]
+            name = f"bench-{kind}-{count}"
+            match kind:
+                case 'apt':
+                    states.append(Apt(name))
+                case 'flatpak':
+                    states.append(Flatpak(f"org.bench.App{count}"))
+                case 'snap':
+                    states.append(Snap(name, classic=rng.random() < 0.3))
+                case 'pip':
+                    states.append(Pip(name))
+                case 'file':
+                    path = f"/opt/bench/{name}"
+                    states.append(Command(Shell(f"touch {path}"), Shell(f"rm {path}"), Shell(f"test -f {path}")))
+                case 'dir':
+                    path = f"/opt/bench/{name}"
+                    states.append(Command(Shell(f"mkdir -p {path}"), Shell(f"rm -r {path}"), Shell(f"test -d {path}")))
+                case 'link':
+                    path = f"/opt/bench/{name}"
+                    states.append(Command(Shell(f"ln -s /bin/true {path}"), Shell(f"rm {path}"), Shell(f"test -L {path}")))
+            count += 1
+        section = Parallel(*states) if rng.random() < 0.25 else Chain(*states)
+        if sections and rng.random() < 0.3:
+            section.require(rng.choice(sections))
+        sections.append(section)
+    return Graph(base, *sections, width=8)
+
+
+def leaves(state: State) -> list[State]:
+    children = state.children()
+    if not children:
+        return [state]
+    return [leaf for child in children for leaf in leaves(child)]
+
+
+def prepare(root: State, installed: float, seed: int) -> FakeBackend:
+    """
+    Returns a fake system with about the given fraction of the leaves of root already installed.
+    """
+    backend = FakeBackend(latency={}, default_latency=0.0)
+    rng = random.Random(seed)
+    with backend.use(), open(os.devnull, 'w') as null, redirect_stdout(null), Run():
+        for leaf in leaves(root):
+            if rng.random() < installed:
+                leaf.ensure_installed()
+    return backend
+
+
+def converge(root: State, run: Run, use_async: bool) -> None:
+    with run:
+        if use_async:
+            asyncio.run(root.async_ensure_installed())
+        else:
+            root.ensure_installed()
+
+
+def detect_only(root: State, run: Run, use_async: bool) -> None:
+    with run:
+        root.plan()
+
+
+def measure(name: str, root: State, backend: FakeBackend, fn, run: Run, use_async: bool) -> dict:
+    commands = backend.commands
+    with backend.use(), open(os.devnull, 'w') as null, redirect_stdout(null):
+        start = time.perf_counter()
+        fn(root, run, use_async)
+        seconds = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'seconds': seconds,
+        'commands': backend.commands - commands,
+        'detects': run.detects,
+        'avoided': run.avoided,
+        'cached': run.cached,
+        'trusted': run.trusted,
+    }
+
+
+def bench(root: State, args) -> list[dict]:
+    """
+    Runs every scenario once on a freshly prepared fake system.
+    """
+    results = []
+    backend = prepare(root, args.installed, args.seed)
+    backend.latency, backend.default_latency = args.latency, args.default_latency
+    results.append(measure('detect-only', root, backend, detect_only, Run(), args.use_async))
+    results.append(measure('converge', root, backend, converge, Run(), args.use_async))
+    results.append(measure('no-op', root, backend, converge, Run(), args.use_async))
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = DetectCache(os.path.join(tmp, 'detect.json'))
+        measure('no-op (fill cache)', root, backend, converge, Run(cache=cache), args.use_async)
+        results.append(measure('no-op cached', root, backend, converge, Run(cache=DetectCache(cache.path)), args.use_async))
+        log = ConvergeLog(os.path.join(tmp, 'converged.json'))
+        measure('no-op (fill log)', root, backend, converge, Run(converged=log), args.use_async)
+        results.append(measure('changed-only', root, backend, converge, Run(converged=ConvergeLog(log.path, trust=True)), args.use_async))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark detect-only runs, converges and no-op re-runs against a fake system")
+    parser.add_argument('--states', type=int, default=1000, help="number of leaf states of the synthetic config")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic config and the preinstalled states")
+    parser.add_argument('--installed', type=float, default=0.5, help="fraction of states installed before the detect-only run and the converge")
+    parser.add_argument('--repeat', type=int, default=1, help="number of measurements per scenario")
+    parser.add_argument('--latency', action='append', default=[], metavar='COMMAND=SECONDS', help="latency of a command, e.g. 'apt install=0.5'")
+    parser.add_argument('--default-latency', type=float, default=0.001, help="latency of commands without a latency entry")
+    parser.add_argument('--no-latency', action='store_true', help="run every command without latency")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="converge with async_ensure_installed")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    latency = {} if args.no_latency else dict(DEFAULT_LATENCY)
+    for entry in args.latency:
+        command, _, seconds = entry.rpartition('=')
+        latency[command] = float(seconds)
+    args.latency = latency
+    if args.no_latency:
+        args.default_latency = 0.0
+    # the lists of the machine running the benchmark must not decide about an 'apt update'
+    AptLists.max_age = float('inf')
+
+    root = synthetic(args.states, args.seed)
+    runs = [bench(root, args) for _ in range(args.repeat)]
+    scenarios = []
+    for measurements in zip(*runs):
+        seconds = [m['seconds'] for m in measurements]
+        scenarios.append(dict(measurements[0], seconds=statistics.median(seconds), min_seconds=min(seconds)))
+
+    if args.json:
+        json.dump({
+            'states': args.states,
+            'seed': args.seed,
+            'installed': args.installed,
+            'repeat': args.repeat,
+            'async': args.use_async,
+            'latency': args.latency,
+            'default_latency': args.default_latency,
+            'python': sys.version.split()[0],
+            'scenarios': scenarios,
+        }, sys.stdout, indent=2)
+        print()
+        return
+
+    print(f"# {args.states} states, seed {args.seed}, {args.installed:.0%} installed, median of {args.repeat}")
+    print(f"{'scenario':<14} {'median s':>9} {'min s':>9} {'commands':>9} {'detects':>8} {'avoided':>8} {'cached':>7} {'trusted':>8}")
+    for s in scenarios:
+        print(f"{s['scenario']:<14} {s['seconds']:>9.3f} {s['min_seconds']:>9.3f} {s['commands']:>9} {s['detects']:>8} {s['avoided']:>8} {s['cached']:>7} {s['trusted']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -28,7 +28,7 @@ if __name__ == '__main__':
             dependency=Command(
                 install=Shell('wget https://github.com/jgm/pandoc/releases/download/3.6.1/pandoc-3.6.1-1-amd64.deb -qO /tmp/pandoc.deb'),
                 uninstall=Shell('rm /tmp/pandoc.deb'),
-                detect=Shell('test -f /tmp/pandoc.deb'),
+                detect=FileExists('/tmp/pandoc.deb'),
             ),
             # A utility for Dpkg already exists and we use it here as target State.
             # Notice: here we can access the previously downloaded file '/tmp/pandoc.deb'.
@@ -1,84 +1,1585 @@
+from __future__ import annotations
 
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from io import StringIO
+
+
+class DetectCache:
+    """
+    Persistent cache of detect results stored in a JSON file.
+    An entry is used as long as the fingerprint of its State didn't change and the entry isn't older than ttl seconds.
+    """
+    def __init__(self, path: str = '~/.cache/systemgoverner/detect.json', ttl: float = 24 * 60 * 60):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self._entries = None
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    @staticmethod
+    def _key(state: State) -> str:
+        return state.structural_hash()
+
+    def get(self, state: State, fingerprint: str) -> bool | None:
+        """
+        Returns the cached detect result, None if there is no valid entry.
+        """
+        with self._lock:
+            entry = self._load().get(self._key(state))
+        if entry is None or entry['fingerprint'] != fingerprint or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['result']
+
+    def put(self, state: State, fingerprint: str, result: bool) -> None:
+        with self._lock:
+            self._load()[self._key(state)] = {'result': result, 'time': time.time(), 'fingerprint': fingerprint}
+            self._changed = True
+
+    def discard(self, state: State) -> None:
+        with self._lock:
+            if self._load().pop(self._key(state), None) is not None:
+                self._changed = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._changed:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+            self._changed = False
+
+
+class ConvergeLog:
+    """
+    Persistent record of the structural hashes of States found installed by previous Runs.
+    With trust, a State whose hash is recorded counts as installed without detecting it, so only
+    new or changed parts of a config are detected. Nothing is trusted once the last full verification,
+    a Run without trust, is older than verify_after seconds.
+    Composite States are recorded with the hashes of the States they encapsulate, so discarding a State
+    also discards every recorded State containing it.
+    """
+    def __init__(self, path: str = '~/.cache/systemgoverner/converged.json', trust: bool = False, verify_after: float = 7 * 24 * 60 * 60):
+        """
+        path: JSON file of the record
+        trust: consider recorded States installed
+        verify_after: seconds after a full verification until States aren't trusted anymore
+        """
+        self.path = os.path.expanduser(path)
+        self.trust = trust
+        self.verify_after = verify_after
+        self._entries = None
+        self._trusted = None
+        # hash of a State -> hashes of the recorded States containing it
+        self._containing = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {'verified': 0.0, 'hashes': {}}
+            self._entries.setdefault('parts', {})
+            for key, parts in self._entries['parts'].items():
+                self._contain(key, parts)
+            # States recorded in this Run aren't trusted before the next one
+            verified = time.time() - self._entries['verified'] <= self.verify_after
+            self._trusted = set(self._entries['hashes']) if self.trust and verified else set()
+        return self._entries
+
+    def trusts(self, state: State) -> bool:
+        with self._lock:
+            self._load()
+            return state.structural_hash() in self._trusted
+
+    def _contain(self, key: str, parts: list[str]) -> None:
+        for part in parts:
+            self._containing.setdefault(part, set()).add(key)
+
+    def add(self, state: State) -> None:
+        key = state.structural_hash()
+        parts = [s.structural_hash() for s in _walk(state) if s is not state] if state.children() else []
+        with self._lock:
+            entries = self._load()
+            entries['hashes'][key] = time.time()
+            if parts:
+                entries['parts'][key] = parts
+                self._contain(key, parts)
+
+    def discard(self, state: State) -> None:
+        """
+        Discards state and the recorded States containing it, their detect result may have changed with it.
+        """
+        key = state.structural_hash()
+        with self._lock:
+            entries = self._load()
+            for k in (key, *self._containing.get(key, ())):
+                entries['hashes'].pop(k, None)
+                entries['parts'].pop(k, None)
+                self._trusted.discard(k)
+
+    def save(self, verified: bool) -> None:
+        """
+        verified: the Run detected without trust and succeeded
+        """
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            if verified and not self._trusted:
+                entries['verified'] = now
+            # hashes of States removed from the config are dropped once a few verifications didn't see them
+            entries['hashes'] = {key: t for key, t in entries['hashes'].items() if now - t <= 2 * self.verify_after}
+            entries['parts'] = {key: parts for key, parts in entries['parts'].items() if key in entries['hashes']}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+
+
+class Span:
+    """
+    Timing of a single detect, install or uninstall call of a State, with the processes it ran.
+    """
+    def __init__(self, name: str, op: str, parent: Span | None, tid: int):
+        self.name = name
+        self.op = op
+        self.parent = parent
+        self.tid = tid
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = 0.0
+        self.error = None
+        self.exit_codes = []
+        self.stdout = 0
+        self.stderr = 0
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    @property
+    def self_time(self) -> float:
+        # concurrent children can add up to more than the wall time of their parent
+        return max(0.0, self.duration - self.children)
+
+
+class Tracer:
+    """
+    Records a Span for every detect, install and uninstall call during a Run.
+    Exports them as Chrome trace events (chrome://tracing, Perfetto) and summarizes the slowest States.
+    """
+    _span: ContextVar = ContextVar('span', default=None)
+
+    def __init__(self, path: str = None, top: int = 10):
+        """
+        path: file the Chrome trace is written to at the end of the Run, not written if None
+        top: number of slowest States printed at the end of the Run, nothing printed if 0
+        """
+        self.path = path
+        self.top = top
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def current(cls) -> Tracer | None:
+        run = Run.current()
+        return run.tracer if run is not None else None
+
+    @contextmanager
+    def span(self, name: str, op: str):
+        parent = self._span.get()
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        # overlapping tasks of an event loop must not share a track
+        span = Span(name, op, parent, id(task) if task is not None else threading.get_ident())
+        with self._lock:
+            self.spans.append(span)
+        token = self._span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._span.reset(token)
+            span.end = time.perf_counter()
+            if parent is not None:
+                with self._lock:
+                    parent.children += span.duration
+
+    @classmethod
+    def _traces(cls, name: str, op: str) -> bool:
+        # a State calling the method of its base class is a single call
+        span = cls._span.get()
+        return span is None or span.op != op or span.name != name
+
+    @classmethod
+    def process(cls, r, stdout: int = None, stderr: int = None) -> None:
+        """
+        Adds a finished process, e.g. a subprocess.CompletedProcess, to the active Span.
+        stdout, stderr: bytes the process wrote, if its result keeps only part of them, e.g. of streamed output
+        """
+        span = cls._span.get()
+        if span is None:
+            return
+        span.exit_codes.append(r.returncode)
+        span.stdout += len(r.stdout or b'') if stdout is None else stdout
+        span.stderr += len(r.stderr or b'') if stderr is None else stderr
+
+    def chrome_trace(self) -> dict:
+        """
+        Returns the spans as Chrome trace event format.
+        """
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for span in spans:
+            args = {'processes': len(span.exit_codes), 'exit_codes': span.exit_codes, 'stdout_bytes': span.stdout, 'stderr_bytes': span.stderr}
+            if span.error is not None:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.op,
+                'ph': 'X',
+                'ts': (span.start - self._origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.tid,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path: str = None) -> None:
+        path = os.path.expanduser(path or self.path)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self, top: int = None) -> str:
+        """
+        Returns the States with the most time spent in themselves rather than in encapsulated States.
+        """
+        top = self.top if top is None else top
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.self_time, reverse=True)[:top]
+        lines = [f"# {len(spans)} slowest of {len(self.spans)} state calls (self / wall seconds)"]
+        for span in spans:
+            codes = ' '.join(str(code) for code in span.exit_codes)
+            processes = f"{len(span.exit_codes)} processes" + (f" [{codes}]" if codes else '')
+            lines.append(f"#   {span.self_time:8.2f} {span.duration:8.2f}  {span.op:<9} {span.name}  {processes}, {span.stdout} B stdout, {span.stderr} B stderr")
+        return '\n'.join(lines)
+
+
+def _traced(op: str, fn):
+    @functools.wraps(fn)
+    def traced(self, *args, **kwargs):
+        tracer = Tracer.current()
+        if tracer is None or not Tracer._traces(name := repr(self), op):
+            return fn(self, *args, **kwargs)
+        with tracer.span(name, op):
+            return fn(self, *args, **kwargs)
+    return traced
+
+
+def _async_traced(op: str, fn):
+    @functools.wraps(fn)
+    async def traced(self, *args, **kwargs):
+        tracer = Tracer.current()
+        if tracer is None or not Tracer._traces(name := repr(self), op):
+            return await fn(self, *args, **kwargs)
+        with tracer.span(name, op):
+            return await fn(self, *args, **kwargs)
+    return traced
+
+
+def _batch_traced(op: str, fn):
+    @functools.wraps(fn)
+    def traced(cls, states, *args, **kwargs):
+        tracer = Tracer.current()
+        if tracer is None:
+            return fn(cls, states, *args, **kwargs)
+        with tracer.span(f"{cls.__name__}{list(states)}", op):
+            return fn(cls, states, *args, **kwargs)
+    return traced
+
+
+class _Resource:
+    """
+    Lock of a resource held by one State at a time, waited for by threads and event loop tasks alike.
+    Tasks wait on a future instead of a thread, so waiting tasks never use up the threads of an executor.
+    """
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._released = threading.Condition(self._mutex)
+        self._held = False
+        self._waiting = []
+
+    def acquire(self) -> None:
+        with self._released:
+            while self._held:
+                self._released.wait()
+            self._held = True
+
+    async def async_acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._mutex:
+                if not self._held:
+                    self._held = True
+                    return
+                waiter = (loop, loop.create_future())
+                self._waiting.append(waiter)
+            try:
+                await waiter[1]
+            finally:
+                # a cancelled task doesn't acquire the lock later, it just stops waiting
+                with self._mutex:
+                    if waiter in self._waiting:
+                        self._waiting.remove(waiter)
+
+    def release(self) -> None:
+        with self._released:
+            self._held = False
+            self._released.notify()
+            waiting, self._waiting = self._waiting, []
+        # all waiting tasks try again, those losing to another holder wait anew
+        for loop, future in waiting:
+            loop.call_soon_threadsafe(_wake, future)
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Run:
+    """
+    Context of a single run over a State tree.
+    Memoizes detect results of States and holds run scoped objects like package inventories.
+    ensure_installed and ensure_uninstalled start a Run if none is active.
+    """
+    _current: ContextVar = ContextVar('run', default=None)
+    # resources held by the current context, nested States reuse them instead of waiting on themselves
+    _held: ContextVar = ContextVar('held_resources', default=frozenset())
+
+    def __init__(self, cache: DetectCache = None, tracer: Tracer = None, converged: ConvergeLog = None):
+        """
+        cache: persistent cache for detect results of States with a fingerprint, disabled if None
+        tracer: records the timing of every State call, disabled if None
+        converged: record of installed States, trusted instead of detecting them if enabled, disabled if None
+        """
+        self.cache = cache
+        self.tracer = tracer
+        self.converged = converged
+        self._detected = {}
+        self._scoped = {}
+        self._resources = {}
+        self._lock = threading.RLock()
+        self._tokens = []
+        self.detects = 0
+        self.avoided = 0
+        self.cached = 0
+        self.trusted = 0
+
+    @classmethod
+    def current(cls) -> Run | None:
+        return cls._current.get()
+
+    @classmethod
+    @contextmanager
+    def ensure(cls):
+        """
+        Yields the active Run or a new Run that ends afterwards.
+        """
+        run = cls.current()
+        if run is not None:
+            yield run
+            return
+        with cls() as run:
+            yield run
+
+    def __enter__(self) -> Run:
+        self._tokens.append(self._current.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        self._current.reset(self._tokens.pop())
+        if self._tokens:
+            return
+        if self.cache is not None:
+            self.cache.save()
+        if self.converged is not None:
+            self.converged.save(verified=exc[0] is None)
+        if self.avoided or self.cached or self.trusted:
+            total = self.detects + self.avoided + self.cached + self.trusted
+            print(f"# {self.avoided + self.cached + self.trusted} of {total} detect calls avoided ({self.cached} from cache, {self.trusted} unchanged since converged)")
+        if self.tracer is not None:
+            if self.tracer.top:
+                print(self.tracer.summary())
+            if self.tracer.path is not None:
+                self.tracer.save()
+
+    def _lookup(self, state: State) -> tuple[bool | None, str | None]:
+        """
+        Returns the memoized or cached detect result of state, None if unknown, and the fingerprint of state.
+        """
+        with self._lock:
+            if state in self._detected:
+                self.avoided += 1
+                return self._detected[state], None
+        if self.converged is not None and self.converged.trusts(state):
+            with self._lock:
+                self.trusted += 1
+                self._detected[state] = True
+            return True, None
+        fingerprint = state.fingerprint() if self.cache is not None else None
+        result = None if fingerprint is None else self.cache.get(state, fingerprint)
+        if result is not None:
+            self.record(state, result)
+            with self._lock:
+                self.cached += 1
+                self._detected[state] = result
+        return result, fingerprint
+
+    def record(self, state: State, installed: bool) -> None:
+        """
+        Records in converged whether state was found or made installed.
+        """
+        if self.converged is None:
+            return
+        if installed:
+            self.converged.add(state)
+        else:
+            self.converged.discard(state)
+
+    def confirm(self, state: State) -> None:
+        """
+        Detects state again after it was installed, so converged records it only if it is really installed,
+        e.g. Try installs without an error even if its State failed.
+        """
+        if self.converged is not None:
+            self.detect(state)
+
+    async def async_confirm(self, state: State) -> None:
+        """
+        Asynchronous version of confirm.
+        """
+        if self.converged is not None:
+            await self.async_detect(state)
+
+    def _store(self, state: State, fingerprint: str | None, result: bool) -> None:
+        self.record(state, result)
+        if fingerprint is not None:
+            self.cache.put(state, fingerprint, result)
+        with self._lock:
+            self.detects += 1
+            self._detected[state] = result
+
+    def detect(self, state: State) -> bool:
+        """
+        Returns the memoized detect result of state, detects it on first use.
+        """
+        result, fingerprint = self._lookup(state)
+        if result is None:
+            result = state.detect()
+            self._store(state, fingerprint, result)
+        return result
+
+    async def async_detect(self, state: State) -> bool:
+        """
+        Asynchronous version of detect.
+        """
+        result, fingerprint = self._lookup(state)
+        if result is None:
+            result = await state.async_detect()
+            self._store(state, fingerprint, result)
+        return result
+
+    def invalidate(self, *states: State) -> None:
+        """
+        Forgets the detect result of states and all States declared as affected by them.
+        """
+        with self._lock:
+            todo, seen = list(states), set()
+            while todo:
+                state = todo.pop()
+                if state in seen:
+                    continue
+                seen.add(state)
+                self._detected.pop(state, None)
+                if self.cache is not None:
+                    self.cache.discard(state)
+                if self.converged is not None:
+                    self.converged.discard(state)
+                todo.extend(state.affected())
+
+    def scoped(self, factory):
+        """
+        Returns the object created by factory for this Run, created on first use.
+        """
+        with self._lock:
+            if factory not in self._scoped:
+                self._scoped[factory] = factory()
+            return self._scoped[factory]
+
+    def _locks(self, names) -> tuple[list[str], list[_Resource]]:
+        # sorted, so concurrent holders acquire locks in the same order and can't deadlock
+        names = sorted(set(names) - self._held.get())
+        with self._lock:
+            return names, [self._resources.setdefault(name, _Resource()) for name in names]
+
+    @contextmanager
+    def hold(self, names):
+        """
+        Holds the named resources, e.g. 'dpkg-lock', waiting until no other State of this Run holds them.
+        """
+        names, locks = self._locks(names)
+        for lock in locks:
+            lock.acquire()
+        token = self._held.set(self._held.get() | set(names))
+        try:
+            yield
+        finally:
+            self._held.reset(token)
+            for lock in reversed(locks):
+                lock.release()
+
+    @asynccontextmanager
+    async def async_hold(self, names):
+        """
+        Asynchronous version of hold.
+        """
+        names, locks = self._locks(names)
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.async_acquire()
+                acquired.append(lock)
+        except BaseException:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+        token = self._held.set(self._held.get() | set(names))
+        try:
+            yield
+        finally:
+            self._held.reset(token)
+            for lock in reversed(locks):
+                lock.release()
 
 
 class State(ABC):
     """
-    Abstraction for installing, detecting and uninstalling a target state from the system.
-    Contains also convenience methods.
+    Abstraction for installing, detecting and uninstalling a target state from the system.
+    Contains also convenience methods.
+    """
+    __slots__ = ('_args', '_identity', '_structural_hash', '_required', '_affected', '_holds', '__weakref__')
+    # rough estimate of the seconds needed to install or uninstall this State
+    cost: float = 1.0
+    # States of this class with the same constructor arguments are one shared instance
+    interned: bool = True
+    # levels of encapsulated States shown by repr, deeper States are shown by class and structural_hash
+    repr_depth: int = 2
+    _instances = weakref.WeakValueDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # trace the methods defined by this class, calls are only recorded while the Run has a Tracer
+        for op in ('detect', 'install', 'uninstall'):
+            fn = cls.__dict__.get(op)
+            if fn is not None and not getattr(fn, '__isabstractmethod__', False):
+                setattr(cls, op, _traced(op, fn))
+            fn = cls.__dict__.get(f"async_{op}")
+            if fn is not None:
+                setattr(cls, f"async_{op}", _async_traced(op, fn))
+        for op in ('install', 'uninstall'):
+            batch = cls.__dict__.get(f"{op}_batch")
+            if isinstance(batch, classmethod):
+                setattr(cls, f"{op}_batch", classmethod(_batch_traced(op, batch.__func__)))
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Returns the existing instance if an interned State of the same class and arguments is alive,
+        so duplicates in a config are one node which is detected and installed once.
+        Declarations like require apply to all its uses.
+        """
+        identity = f"{cls.__module__}.{cls.__qualname__}({', '.join(_params(cls, args, kwargs))})"
+        if not cls.interned:
+            return cls._create(identity, args, kwargs)
+        with State._instances_lock:
+            self = State._instances.get(identity)
+            if self is None:
+                self = State._instances[identity] = cls._create(identity, args, kwargs)
+        return self
+
+    @classmethod
+    def _create(cls, identity: str, args: tuple, kwargs: dict) -> State:
+        self = super().__new__(cls)
+        self._args = (args, kwargs)
+        self._identity = identity
+        self._structural_hash = None
+        return self
+
+    def __repr__(self) -> str:
+        return self._repr(self.repr_depth)
+
+    def _repr(self, depth: int) -> str:
+        if depth < 0:
+            return f"{type(self).__name__}<{self.structural_hash()[:12]}>"
+        args, kwargs = getattr(self, '_args', ((), {}))
+        params = [_repr_arg(a, depth - 1) for a in args] + [f"{k}={_repr_arg(v, depth - 1)}" for k, v in kwargs.items()]
+        return f"{type(self).__name__}({', '.join(params)})"
+
+    def identity(self) -> str:
+        """
+        Returns a stable identity of this State built from its class and constructor arguments,
+        encapsulated States are represented by their structural_hash.
+        """
+        return self._identity
+
+    def structural_hash(self) -> str:
+        """
+        Returns a hash of identity, which changes whenever this State or a State encapsulated by it is changed in the config.
+        """
+        if self._structural_hash is None:
+            self._structural_hash = hashlib.sha256(self.identity().encode()).hexdigest()
+        return self._structural_hash
+
+    def fingerprint(self) -> str | None:
+        """
+        Returns a cheap fingerprint of everything detect depends on, e.g. file modification times.
+        None if the detect result can't be cached.
+        """
+        return None
+
+    def watch_paths(self) -> tuple[str, ...]:
+        """
+        Returns the files and directories whose changes can change the detect result, watched by Watcher.
+        Encapsulated States are watched by their own paths.
+        """
+        return ()
+
+    @abstractmethod
+    def detect(self) -> bool:
+        """
+        Returns true if the target state is already installed false otherwise.
+        """
+        pass
+
+    @abstractmethod
+    def install(self) -> None:
+        """
+        Installs target state on system. 
+        Undefined behavior if target State is already installed.
+        """
+        pass
+
+    @abstractmethod
+    def uninstall(self) -> None:
+        """
+        Uninstalls target state from system.
+        Undefined behavior if target State is already uninstalled.
+        """
+        pass
+
+    async def async_detect(self) -> bool:
+        """
+        Asynchronous version of detect, runs detect in a thread unless overridden.
+        """
+        return await asyncio.to_thread(self.detect)
+
+    async def async_install(self) -> None:
+        """
+        Asynchronous version of install, runs install in a thread unless overridden.
+        """
+        await asyncio.to_thread(self.install)
+
+    async def async_uninstall(self) -> None:
+        """
+        Asynchronous version of uninstall, runs uninstall in a thread unless overridden.
+        """
+        await asyncio.to_thread(self.uninstall)
+
+    def batch_key(self):
+        """
+        Returns a key shared by States of the same class that can be installed or uninstalled together in one transaction.
+        None if the State can't be batched.
+        """
+        return None
+
+    @classmethod
+    def install_batch(cls, states: list[State]) -> None:
+        """
+        Installs multiple not installed States of this class sharing the same batch_key.
+        Defaults to installing them one by one.
+        """
+        for state in states:
+            state.install()
+
+    @classmethod
+    async def async_install_batch(cls, states: list[State]) -> None:
+        """
+        Asynchronous version of install_batch, runs install_batch in a thread unless overridden.
+        """
+        await asyncio.to_thread(cls.install_batch, states)
+
+    @classmethod
+    def uninstall_batch(cls, states: list[State]) -> None:
+        """
+        Uninstalls multiple installed States of this class sharing the same batch_key.
+        Defaults to uninstalling them one by one.
+        """
+        for state in states:
+            state.uninstall()
+
+    @classmethod
+    async def async_uninstall_batch(cls, states: list[State]) -> None:
+        """
+        Asynchronous version of uninstall_batch, runs uninstall_batch in a thread unless overridden.
+        """
+        await asyncio.to_thread(cls.uninstall_batch, states)
+
+    def children(self) -> tuple[State, ...]:
+        """
+        Returns the encapsulated States.
+        """
+        return ()
+
+    def plan_install(self, plan: Plan) -> None:
+        """
+        Records the actions install would perform into plan.
+        """
+        plan.add('install', self)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        """
+        Records the actions uninstall would perform into plan.
+        """
+        plan.add('uninstall', self)
+
+    def plan(self, uninstall: bool = False, max_workers: int = None) -> Plan:
+        """
+        Detects the entire tree, concurrently where possible, and returns the actions
+        ensure_installed (or ensure_uninstalled) would perform without performing them.
+        Uses the active Run if any.
+        """
+        return Plan(self, uninstall, max_workers)
+
+    def script_detect(self, script: Script) -> str | None:
+        """
+        Returns shell code exiting with 0 if the target state is installed and > 0 otherwise, see export_script.
+        The code runs inside a shell function, its output is discarded.
+        None if this State can't be exported.
+        """
+        return None
+
+    def script_install(self, script: Script) -> str | None:
+        """
+        Returns shell code installing the target state, exiting with > 0 on failure.
+        The code runs inside a shell function and may return from it.
+        None if this State can't be exported.
+        """
+        return None
+
+    def script_uninstall(self, script: Script) -> str | None:
+        """
+        Returns shell code uninstalling the target state, exiting with > 0 on failure.
+        None if this State can't be exported.
+        """
+        return None
+
+    def script_argument(self) -> str | None:
+        """
+        Returns the quoted shell word naming this State in the command of script_install_batch, e.g. a package name.
+        """
+        return None
+
+    @classmethod
+    def script_install_batch(cls, states: list[State], script: Script) -> str | None:
+        """
+        Returns shell code installing the not installed States of states, which share the same batch_key,
+        in one transaction. The code gets their script_argument as positional parameters ("$@"), its exit code
+        is ignored, States it failed to install are installed one by one.
+        None if they are installed one by one.
+        """
+        return None
+
+    def invalidates(self, *states: State) -> State:
+        """
+        Declares States whose detect result can change when this State is installed or uninstalled.
+        Declaring a State again has no effect.
+        Returns self.
+        """
+        self._affected = _declared(self.affected(), states, State.identity)
+        return self
+
+    def affected(self) -> tuple[State, ...]:
+        return getattr(self, '_affected', ())
+
+    def holds(self, *names: str) -> State:
+        """
+        Declares resources held while this State installs or uninstalls, in addition to resources().
+        Declaring a resource again has no effect.
+        Returns self.
+        """
+        self._holds = _declared(getattr(self, '_holds', ()), names, str)
+        return self
+
+    def resources(self) -> tuple[str, ...]:
+        """
+        Returns the names of system wide resources held while installing or uninstalling, e.g. 'dpkg-lock'.
+        States holding the same resource don't install or uninstall concurrently.
+        """
+        return getattr(self, '_holds', ())
+
+    def require(self, *states: State) -> State:
+        """
+        Declares States that must be installed before this State.
+        ensure_installed installs them first, Graph orders them before the node containing this State.
+        Declaring a State again has no effect.
+        Returns self.
+        """
+        for state in states:
+            assert isinstance(state, State), f"expected State object, got '{state}'"
+        self._required = _declared(self.required(), states, State.identity)
+        return self
+
+    def required(self) -> tuple[State, ...]:
+        return getattr(self, '_required', ())
+
+    def provides(self) -> tuple:
+        """
+        Returns keys of what this State provides to other States, e.g. ('apt', 'flatpak').
+        """
+        return ()
+
+    def needs(self) -> tuple:
+        """
+        Returns keys of what this State implicitly depends on.
+        Graph orders this State after the States providing them, if any.
+        """
+        return ()
+
+    def is_installed(self) -> bool:
+        """
+        Returns the detect result, which is computed once per Run.
+        """
+        run = Run.current()
+        if run is None:
+            return self.detect()
+        return run.detect(self)
+
+    def ensure_installed(self):
+        """
+        Convenience method to install target state if not installed.
+        """
+        with Run.ensure() as run:
+            for state in self.required():
+                state.ensure_installed()
+            if not self.is_installed():
+                try:
+                    with run.hold(self.resources()), _Output.labelled(self):
+                        self.install()
+                finally:
+                    run.invalidate(self)
+                run.confirm(self)
+
+    def ensure_uninstalled(self):
+        """
+        Convenience method to uninstall target state if installed.
+        """
+        with Run.ensure() as run:
+            if self.is_installed():
+                try:
+                    with run.hold(self.resources()), _Output.labelled(self):
+                        self.uninstall()
+                finally:
+                    run.invalidate(self)
+
+    async def async_is_installed(self) -> bool:
+        """
+        Asynchronous version of is_installed.
+        """
+        run = Run.current()
+        if run is None:
+            return await self.async_detect()
+        return await run.async_detect(self)
+
+    async def async_ensure_installed(self):
+        """
+        Asynchronous version of ensure_installed.
+        """
+        with Run.ensure() as run:
+            for state in self.required():
+                await state.async_ensure_installed()
+            if not await self.async_is_installed():
+                try:
+                    async with run.async_hold(self.resources()):
+                        with _Output.labelled(self):
+                            await self.async_install()
+                finally:
+                    run.invalidate(self)
+                await run.async_confirm(self)
+
+    async def async_ensure_uninstalled(self):
+        """
+        Asynchronous version of ensure_uninstalled.
+        """
+        with Run.ensure() as run:
+            if await self.async_is_installed():
+                try:
+                    async with run.async_hold(self.resources()):
+                        with _Output.labelled(self):
+                            await self.async_uninstall()
+                finally:
+                    run.invalidate(self)
+
+
+class Chain(State):
+    """
+    A State for installing, detecting and uninstalling multiple other states.
+    States are installed in order and uninstalled in reverse order, see _uninstall_steps.
+    Nested Chains are spliced in, so Chains can be nested as deep as the config needs.
+    Other composite States, e.g. Try and From, take a few stack frames per level in plan and install,
+    nesting them is limited to a few hundred levels by the recursion limit.
+    """
+    __slots__ = ('states',)
+
+    def __init__(self, *states: State):
+        flat, seen = [], set()
+        for state in states:
+            assert isinstance(state, State), f"expected State object, got '{state}'"
+            # nested Chains are flat already, splicing them in keeps calls from nesting as deep as the config
+            spliced = type(state) is Chain and not (state.required() or state.affected() or state.resources())
+            for s in (state.states if spliced else (state,)):
+                # an interned State declared twice is installed once, at its first position
+                if type(s).interned and s in seen:
+                    continue
+                seen.add(s)
+                flat.append(s)
+        self.states = tuple(flat)
+
+    def detect(self) -> bool:
+        return all(map(lambda s: s.is_installed(), self.states))
+
+    def children(self) -> tuple[State, ...]:
+        return self.states
+
+    def plan_install(self, plan: Plan) -> None:
+        for state in self.states:
+            plan.ensure(state, True)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        for state in reversed(self.states):
+            plan.ensure(state, False)
+
+    def script_detect(self, script: Script) -> str:
+        return ' && '.join(script.detect(s) for s in self.states) or 'true'
+
+    def script_install(self, script: Script) -> str:
+        return '\n'.join(script.batch(batch) for batch in self._batches())
+
+    def script_uninstall(self, script: Script) -> str:
+        return '\n'.join(f"{script.ensure(s, False)} || return 1" for s in reversed(self.states))
+
+    def _batches(self):
+        """
+        Yields runs of adjacent states that share the same class and batch_key.
+        """
+        batch, key = [], None
+        for state in self.states:
+            k = state.batch_key()
+            k = None if k is None else (type(state), k)
+            if batch and (k is None or k != key):
+                yield batch
+                batch = []
+            batch.append(state)
+            key = k
+        if batch:
+            yield batch
+
+    def install(self):
+        with Run.ensure() as run:
+            for batch in self._batches():
+                if len(batch) == 1:
+                    batch[0].ensure_installed()
+                    continue
+                # like ensure_installed of each member, requirements come first
+                for required in _batch_required(batch):
+                    required.ensure_installed()
+                missing = [s for s in batch if not s.is_installed()]
+                if not missing:
+                    continue
+                try:
+                    with run.hold(r for s in missing for r in s.resources()), _Output.labelled(missing):
+                        type(missing[0]).install_batch(missing)
+                finally:
+                    run.invalidate(*missing)
+                for state in missing:
+                    run.confirm(state)
+
+    def uninstall(self):
+        _uninstall(self)
+
+    async def async_detect(self) -> bool:
+        # unlike detect, all states are detected concurrently
+        return all(await asyncio.gather(*(s.async_is_installed() for s in self.states)))
+
+    async def async_install(self):
+        with Run.ensure() as run:
+            for batch in self._batches():
+                if len(batch) == 1:
+                    await batch[0].async_ensure_installed()
+                    continue
+                for required in _batch_required(batch):
+                    await required.async_ensure_installed()
+                detected = await asyncio.gather(*(s.async_is_installed() for s in batch))
+                missing = [s for s, installed in zip(batch, detected) if not installed]
+                if not missing:
+                    continue
+                try:
+                    async with run.async_hold(r for s in missing for r in s.resources()):
+                        with _Output.labelled(missing):
+                            await type(missing[0]).async_install_batch(missing)
+                finally:
+                    run.invalidate(*missing)
+                await asyncio.gather(*(run.async_confirm(state) for state in missing))
+
+    async def async_uninstall(self):
+        await _async_uninstall(self)
+
+
+def _batch_required(states: list[State]) -> list[State]:
+    """
+    Returns the States required by members of a batch, each once, in declaration order.
+    """
+    return list(dict.fromkeys(required for state in states for required in state.required()))
+
+
+class _Output:
+    """
+    Proxy for sys.stdout that redirects writes into the buffer of the current context.
+    Keeps the output of concurrently running States apart.
+    """
+    buffer: ContextVar = ContextVar('output_buffer', default=None)
+    # State whose install or uninstall is running, prefixes live output of concurrent States
+    label: ContextVar = ContextVar('output_label', default=None)
+    # output is collected by captured_output, live output included
+    captured: ContextVar = ContextVar('output_captured', default=False)
+    lock = threading.Lock()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    @classmethod
+    def install(cls) -> None:
+        if not isinstance(sys.stdout, cls):
+            sys.stdout = cls(sys.stdout)
+
+    @classmethod
+    def emit(cls, text: str, target) -> None:
+        """
+        Writes text at once into the given buffer, or the real stdout if target is None.
+        """
+        if not text:
+            return
+        with cls.lock:
+            if target is not None:
+                target.write(text)
+                return
+            stream = sys.stdout.stream if isinstance(sys.stdout, cls) else sys.stdout
+            stream.write(text)
+            stream.flush()
+
+    @classmethod
+    @contextmanager
+    def labelled(cls, label):
+        """
+        label: State or list of States, only turned into a string by repr once live output is prefixed with it.
+        """
+        token = cls.label.set(label)
+        try:
+            yield
+        finally:
+            cls.label.reset(token)
+
+    def write(self, text: str) -> int:
+        buffer = self.buffer.get()
+        if buffer is not None:
+            return buffer.write(text)
+        with self.lock:
+            return self.stream.write(text)
+
+    def flush(self) -> None:
+        if self.buffer.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def print_live(line: str) -> None:
+    """
+    Prints line right away, even inside concurrently running States whose output is buffered until they finish.
+    Lines of concurrently running States are prefixed with the State they belong to.
+    """
+    if _Output.captured.get():
+        print(line)
+        return
+    label = _Output.label.get()
+    if _Output.buffer.get() is not None and label is not None:
+        label = repr(label)
+        label = label if len(label) <= 40 else label[:37] + '...'
+        line = f"[{label}] {line}"
+    _Output.emit(line + '\n', None)
+
+
+@contextmanager
+def captured_output():
+    """
+    Collects everything printed within the with block, also by concurrently running States and live output,
+    and yields the StringIO it is collected in.
     """
-    @abstractmethod
+    _Output.install()
+    buffer = StringIO()
+    token = _Output.buffer.set(buffer)
+    captured = _Output.captured.set(True)
+    try:
+        yield buffer
+    finally:
+        _Output.captured.reset(captured)
+        _Output.buffer.reset(token)
+
+
+def _buffered(fn, item):
+    parent = _Output.buffer.get()
+    buffer = StringIO()
+    _Output.buffer.set(buffer)
+    try:
+        return fn(item)
+    finally:
+        _Output.emit(buffer.getvalue(), parent)
+
+
+def _concurrently(fn, items, max_workers: int = None) -> tuple[list, list[Exception]]:
+    """
+    Calls fn on all items on a thread pool, with the output of each call buffered.
+    Returns the results of the successful calls and the exceptions of the failed calls.
+    """
+    _Output.install()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(copy_context().run, _buffered, fn, item) for item in items]
+    results, errors = [], []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    return results, errors
+
+
+async def _async_concurrently(fn, items, max_workers: int = None) -> tuple[list, list[Exception]]:
+    """
+    Asynchronous version of _concurrently, awaits fn for all items concurrently.
+    """
+    _Output.install()
+    limit = asyncio.Semaphore(max_workers) if max_workers else None
+
+    async def buffered(item):
+        parent = _Output.buffer.get()
+        buffer = StringIO()
+        _Output.buffer.set(buffer)
+        try:
+            if limit is None:
+                return await fn(item)
+            async with limit:
+                return await fn(item)
+        finally:
+            _Output.emit(buffer.getvalue(), parent)
+
+    outcomes = await asyncio.gather(*(buffered(item) for item in items), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+            raise outcome
+    results = [o for o in outcomes if not isinstance(o, Exception)]
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    return results, errors
+
+
+class Parallel(State):
+    """
+    A State that installs, detects, and uninstalls multiple other states concurrently.
+    The output of each state is buffered and printed once the state is done.
+    Exceptions of all failed states are collected and raised together as an ExceptionGroup.
+    """
+    __slots__ = ('states', 'max_workers')
+
+    def __init__(self, *states: State, max_workers: int = None):
+        """
+        states: independent states, no order is guaranteed
+        max_workers: maximal number of concurrently running states, defaults to ThreadPoolExecutor's default
+        """
+        for state in states:
+            assert isinstance(state, State), f"expected State object, got '{state}'"
+        self.states = states
+        self.max_workers = max_workers
+
+    def _map(self, fn) -> list:
+        results, errors = _concurrently(fn, self.states, self.max_workers)
+        if errors:
+            raise ExceptionGroup(f"{len(errors)} of {len(self.states)} parallel states failed", errors)
+        return results
+
     def detect(self) -> bool:
+        return all(self._map(lambda s: s.is_installed()))
+
+    def children(self) -> tuple[State, ...]:
+        return self.states
+
+    def plan_install(self, plan: Plan) -> None:
+        for state in self.states:
+            plan.ensure(state, True)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        for state in self.states:
+            plan.ensure(state, False)
+
+    def script_detect(self, script: Script) -> str:
+        return ' && '.join(script.detect(s) for s in self.states) or 'true'
+
+    def script_install(self, script: Script) -> str:
+        # one after another, but like install the remaining states still run after a failure
+        return script.each(script.ensure(s, True) for s in self.states)
+
+    def script_uninstall(self, script: Script) -> str:
+        return script.each(script.ensure(s, False) for s in self.states)
+
+    def install(self):
+        self._map(lambda s: s.ensure_installed())
+
+    def uninstall(self):
+        self._map(lambda s: s.ensure_uninstalled())
+
+    async def _async_map(self, fn) -> list:
+        results, errors = await _async_concurrently(fn, self.states, self.max_workers)
+        if errors:
+            raise ExceptionGroup(f"{len(errors)} of {len(self.states)} parallel states failed", errors)
+        return results
+
+    async def async_detect(self) -> bool:
+        return all(await self._async_map(lambda s: s.async_is_installed()))
+
+    async def async_install(self):
+        await self._async_map(lambda s: s.async_ensure_installed())
+
+    async def async_uninstall(self):
+        await self._async_map(lambda s: s.async_ensure_uninstalled())
+
+
+class Graph(State):
+    """
+    A State that installs its states concurrently in dependency order, and uninstalls them in reverse dependency order.
+    Dependencies are declared explicitly with State.require, or implicitly by a State needing what another provides,
+    e.g. Flatpak needs the flatpak package provided by Apt('flatpak').
+    The edges of a node are the dependencies of all States inside it.
+    """
+    __slots__ = ('states', 'width', 'critical_path')
+
+    def __init__(self, *states: State, width: int = None):
         """
-        Returns true if the target state is already installed false otherwise.
+        states: nodes of the graph, required States outside the graph are added as nodes
+        width: maximal number of concurrently running nodes, defaults to ThreadPoolExecutor's default
         """
-        pass
+        for state in states:
+            assert isinstance(state, State), f"expected State object, got '{state}'"
+        self.states = states
+        self.width = width
+        self.critical_path: list[tuple[State, float]] = []
 
-    @abstractmethod
-    def install(self) -> None:
+    def children(self) -> tuple[State, ...]:
+        return self.states
+
+    def edges(self) -> tuple[list[State], dict[State, set[State]]]:
         """
-        Installs target state on system. 
-        Undefined behavior if target State is already installed.
+        Returns the nodes and for each node the nodes it depends on.
         """
-        pass
+        nodes, owner, providers = [], {}, {}
 
-    @abstractmethod
-    def uninstall(self) -> None:
+        def add(node: State):
+            nodes.append(node)
+            for state in _walk(node):
+                owner.setdefault(state, node)
+                for key in state.provides():
+                    providers.setdefault(key, node)
+
+        for state in dict.fromkeys(self.states):
+            add(state)
+        i = 0
+        while i < len(nodes):
+            for state in _walk(nodes[i]):
+                for required in state.required():
+                    if required not in owner:
+                        add(required)
+            i += 1
+
+        deps = {node: set() for node in nodes}
+        for node in nodes:
+            for state in _walk(node):
+                deps[node].update(owner[required] for required in state.required())
+                deps[node].update(providers[key] for key in state.needs() if key in providers)
+            deps[node].discard(node)
+        return nodes, deps
+
+    @staticmethod
+    def _toposort(nodes: list[State], deps: dict[State, set[State]]) -> list[State]:
         """
-        Uninstalls target state from system.
-        Undefined behavior if target State is already uninstalled.
+        Returns the nodes in dependency order, raises an Exception naming a cycle if there is one.
         """
-        pass
+        remaining = {node: set(deps[node]) for node in nodes}
+        dependents = {node: [] for node in nodes}
+        for node in nodes:
+            for dep in deps[node]:
+                dependents[dep].append(node)
+        ready = [node for node in nodes if not remaining[node]]
+        order = []
+        while ready:
+            node = ready.pop(0)
+            order.append(node)
+            for dependent in dependents[node]:
+                remaining[dependent].discard(node)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+        if len(order) == len(nodes):
+            return order
+        # every unordered node waits for another unordered node, follow them until one repeats
+        path, node = [], next(node for node in nodes if remaining[node])
+        while node not in path:
+            path.append(node)
+            node = next(iter(remaining[node]))
+        cycle = path[path.index(node):] + [node]
+        raise Exception(f"dependency cycle: {' -> '.join(map(repr, cycle))}")
 
-    def ensure_installed(self):
+    def _schedule(self, fn, deps: dict[State, set[State]]) -> None:
         """
-        Convenience method to install target state if not installed.
+        Calls fn on every node once all its dependencies succeeded, with at most width nodes at once.
         """
-        if not self.detect():
-            self.install()
+        self.critical_path = []
+        nodes = self._toposort(list(deps), deps)
+        waiting = {node: len(deps[node]) for node in nodes}
+        dependents = {node: [] for node in nodes}
+        for node in nodes:
+            for dep in deps[node]:
+                dependents[dep].append(node)
+        durations, errors = {}, []
 
-    def ensure_uninstalled(self):
+        def timed(node: State) -> float:
+            start = time.monotonic()
+            fn(node)
+            return time.monotonic() - start
+
+        _Output.install()
+        with ThreadPoolExecutor(max_workers=self.width) as pool:
+            running = {}
+
+            def submit(node: State):
+                running[pool.submit(copy_context().run, _buffered, timed, node)] = node
+
+            for node in nodes:
+                if waiting[node] == 0:
+                    submit(node)
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        durations[node] = future.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    for dependent in dependents[node]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            submit(dependent)
+
+        self._finish(nodes, deps, durations, errors, [node for node in nodes if waiting[node]])
+
+    async def _async_schedule(self, fn, deps: dict[State, set[State]]) -> None:
         """
-        Convenience method to uninstall target state if installed.
+        Asynchronous version of _schedule, awaits fn on every node in a task of the event loop instead of a thread.
         """
-        if self.detect():
-            self.uninstall()
+        self.critical_path = []
+        nodes = self._toposort(list(deps), deps)
+        limit = asyncio.Semaphore(self.width) if self.width else nullcontext()
+        durations, errors, skipped, tasks = {}, [], [], {}
 
+        async def run(node: State) -> bool:
+            # dependencies come first in the toposort, so their tasks exist already
+            if not all(await asyncio.gather(*(tasks[dep] for dep in deps[node]))):
+                skipped.append(node)
+                return False
+            parent = _Output.buffer.get()
+            buffer = StringIO()
+            _Output.buffer.set(buffer)
+            try:
+                async with limit:
+                    start = time.monotonic()
+                    await fn(node)
+                    durations[node] = time.monotonic() - start
+                return True
+            except Exception as e:
+                errors.append(e)
+                return False
+            finally:
+                _Output.emit(buffer.getvalue(), parent)
 
-class Chain(State):
-    """
-    A State for installing, detecting and uninstalling multiple other states.
-    """
-    def __init__(self, *states: State):
-        for state in states:
-            assert isinstance(state, State), f"expected State object, got '{state}'"
-        self.states = states
+        _Output.install()
+        for node in nodes:
+            tasks[node] = asyncio.create_task(run(node))
+        await asyncio.gather(*tasks.values())
+        self._finish(nodes, deps, durations, errors, skipped)
+
+    def _finish(self, nodes: list[State], deps: dict[State, set[State]], durations: dict[State, float], errors: list[Exception], skipped: list[State]) -> None:
+        self.critical_path = self._critical_path(nodes, deps, durations)
+        if errors:
+            # nodes still waiting for a dependency were never started
+            errors += [Exception(f"skipped {node!r}: a dependency failed") for node in skipped]
+            raise ExceptionGroup(f"{len(errors)} of {len(nodes)} graph nodes failed", errors)
+
+    @staticmethod
+    def _critical_path(nodes: list[State], deps: dict[State, set[State]], durations: dict[State, float]) -> list[tuple[State, float]]:
+        """
+        Returns the chain of dependent nodes with the longest total duration.
+        """
+        finish, previous = {}, {}
+        for node in nodes:
+            if node not in durations:
+                continue
+            before = max((d for d in deps[node] if d in finish), key=finish.get, default=None)
+            previous[node] = before
+            finish[node] = durations[node] + (finish[before] if before is not None else 0)
+        if not finish:
+            return []
+        path, node = [], max(finish, key=finish.get)
+        while node is not None:
+            path.append((node, durations[node]))
+            node = previous[node]
+        return path[::-1]
+
+    def report(self) -> str:
+        """
+        Returns the critical path of the last install or uninstall.
+        """
+        total = sum(duration for _, duration in self.critical_path)
+        steps = ' -> '.join(f"{node!r} ({duration:.1f}s)" for node, duration in self.critical_path)
+        return f"# critical path {total:.1f}s: {steps}"
 
     def detect(self) -> bool:
-        return all(map(lambda s: s.detect(), self.states))
+        results, errors = _concurrently(lambda s: s.is_installed(), self.states, self.width)
+        if errors:
+            raise ExceptionGroup(f"{len(errors)} of {len(self.states)} graph nodes failed to detect", errors)
+        return all(results)
 
     def install(self):
-        for state in self.states:
-            state.ensure_installed()
+        _, deps = self.edges()
+        try:
+            self._schedule(lambda s: s.ensure_installed(), deps)
+        finally:
+            if self.critical_path:
+                print(self.report())
 
     def uninstall(self):
-        for state in self.states:
-            state.ensure_uninstalled()
+        # sequential, since grouping the removals of all nodes saves more than running them concurrently
+        _uninstall(self)
 
+    async def async_detect(self) -> bool:
+        results, errors = await _async_concurrently(lambda s: s.async_is_installed(), self.states, self.width)
+        if errors:
+            raise ExceptionGroup(f"{len(errors)} of {len(self.states)} graph nodes failed to detect", errors)
+        return all(results)
 
-class Parallel(State):
-    """
-    A State that installes, detectes, and uninstalls multiple other states concurrently.
-    """
-    # TODO
-    # probably a bad idea
-    pass
+    async def async_install(self):
+        _, deps = self.edges()
+        try:
+            await self._async_schedule(lambda s: s.async_ensure_installed(), deps)
+        finally:
+            if self.critical_path:
+                print(self.report())
+
+    async def async_uninstall(self):
+        await _async_uninstall(self)
+
+    def plan_install(self, plan: Plan) -> None:
+        nodes, deps = self.edges()
+        for node in self._toposort(nodes, deps):
+            plan.ensure(node, True)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        nodes, deps = self.edges()
+        for node in reversed(self._toposort(nodes, deps)):
+            plan.ensure(node, False)
+
+    def script_detect(self, script: Script) -> str:
+        return ' && '.join(script.detect(s) for s in self.states) or 'true'
+
+    def script_install(self, script: Script) -> str:
+        # in dependency order, a failed node skips only the nodes depending on it
+        nodes, deps = self.edges()
+        failed = {node: f"sg_failed_{script.index(node)}" for node in nodes}
+        lines = ['set -- 0']
+        for node in self._toposort(nodes, deps):
+            skip = ''.join(f"${{{failed[dep]}-}}" for dep in deps[node])
+            run = f"{script.ensure(node, True)} || {{ {failed[node]}=1; set -- 1; }}"
+            lines.append(f"if [ -z \"{skip}\" ]; then {run}; else {failed[node]}=1; set -- 1; fi" if skip else run)
+        lines.append('return "$1"')
+        return '\n'.join(lines)
+
+    def script_uninstall(self, script: Script) -> str:
+        nodes, deps = self.edges()
+        return '\n'.join(f"{script.ensure(node, False)} || return 1" for node in reversed(self._toposort(nodes, deps)))
 
 
 class Try(State):
     """
     State that ignores Exception's from the encapuslated State.
+    A RecursionError is a config nested too deep rather than a failed State and is raised anyway,
+    like Chain describes, Try States can be nested a few hundred levels deep.
     """
+    __slots__ = ('state',)
 
     def __init__(self, state: State):
         self.state = state
@@ -86,29 +1587,88 @@ class Try(State):
     def install(self):
         try:
             self.state.ensure_installed()
+        except RecursionError:
+            raise
         except Exception:
             pass
 
     def uninstall(self):
         try:
             self.state.ensure_uninstalled()
+        except RecursionError:
+            raise
         except Exception:
             pass
 
     def detect(self):
         try:
-            return self.state.detect()
+            return self.state.is_installed()
+        except RecursionError:
+            raise
+        except Exception:
+            return False
+
+    async def async_install(self):
+        try:
+            await self.state.async_ensure_installed()
+        except RecursionError:
+            raise
+        except Exception:
+            pass
+
+    async def async_uninstall(self):
+        try:
+            await self.state.async_ensure_uninstalled()
+        except RecursionError:
+            raise
+        except Exception:
+            pass
+
+    async def async_detect(self):
+        try:
+            return await self.state.async_is_installed()
+        except RecursionError:
+            raise
         except Exception:
             return False
 
+    def children(self) -> tuple[State, ...]:
+        return (self.state,)
+
+    def plan_install(self, plan: Plan) -> None:
+        try:
+            plan.ensure(self.state, True)
+        except RecursionError:
+            raise
+        except Exception:
+            pass
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        try:
+            plan.ensure(self.state, False)
+        except RecursionError:
+            raise
+        except Exception:
+            pass
+
+    def script_detect(self, script: Script) -> str:
+        return script.detect(self.state)
+
+    def script_install(self, script: Script) -> str:
+        return f"{script.ensure(self.state, True)} || true"
+
+    def script_uninstall(self, script: Script) -> str:
+        return f"{script.ensure(self.state, False)} || true"
+
 
 class Invert(State):
     """
     State that switches install and uninstall from the target State, and invertes the detect result.
     """
+    __slots__ = ('target',)
 
     def __init__(self, target: State):
-        self.target = state
+        self.target = target
 
     def install(self):
         self.target.ensure_uninstalled()
@@ -117,13 +1677,42 @@ class Invert(State):
         self.target.ensure_installed()
 
     def detect(self):
-        return not self.target.detect()
+        return not self.target.is_installed()
+
+    async def async_install(self):
+        await self.target.async_ensure_uninstalled()
+
+    async def async_uninstall(self):
+        await self.target.async_ensure_installed()
+
+    async def async_detect(self):
+        return not await self.target.async_is_installed()
+
+    def children(self) -> tuple[State, ...]:
+        return (self.target,)
+
+    def plan_install(self, plan: Plan) -> None:
+        plan.ensure(self.target, False)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        plan.ensure(self.target, True)
+
+    def script_detect(self, script: Script) -> str:
+        return f"! {script.detect(self.target)}"
+
+    def script_install(self, script: Script) -> str:
+        return script.ensure(self.target, False)
+
+    def script_uninstall(self, script: Script) -> str:
+        return script.ensure(self.target, True)
 
 
 class From(State):
     """
     State that installs temporally a dependency State that is required to install the target State.
+    Nested From States take a few stack frames per level, so nesting them is limited to a few hundred levels.
     """
+    __slots__ = ('dependency', 'target')
 
     def __init__(self, dependency: State, target: State):
         self.dependency = dependency
@@ -138,7 +1727,42 @@ class From(State):
         self.target.ensure_uninstalled()
 
     def detect(self):
-        return self.target.detect()
+        return self.target.is_installed()
+
+    async def async_install(self):
+        await self.dependency.async_ensure_installed()
+        await self.target.async_ensure_installed()
+        await self.dependency.async_ensure_uninstalled()
+
+    async def async_uninstall(self):
+        await self.target.async_ensure_uninstalled()
+
+    async def async_detect(self):
+        return await self.target.async_is_installed()
+
+    def children(self) -> tuple[State, ...]:
+        return (self.dependency, self.target)
+
+    def plan_install(self, plan: Plan) -> None:
+        plan.ensure(self.dependency, True)
+        plan.ensure(self.target, True)
+        plan.ensure(self.dependency, False)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        plan.ensure(self.target, False)
+
+    def script_detect(self, script: Script) -> str:
+        return script.detect(self.target)
+
+    def script_install(self, script: Script) -> str:
+        return '\n'.join([
+            f"{script.ensure(self.dependency, True)} || return 1",
+            f"{script.ensure(self.target, True)} || return 1",
+            script.ensure(self.dependency, False),
+        ])
+
+    def script_uninstall(self, script: Script) -> str:
+        return script.ensure(self.target, False)
 
 
 class Print(State):
@@ -146,6 +1770,10 @@ class Print(State):
     State that prints the given message if it is installed or uninstalled.
     Usefull for logging.
     """
+    __slots__ = ('msg',)
+    cost = 0.0
+    # every Print is a separate message, even with the same text
+    interned = False
 
     def __init__(self, msg: str):
         self.msg = msg
@@ -159,11 +1787,37 @@ class Print(State):
     def detect(self) -> bool:
         return False
 
+    async def async_install(self):
+        self.install()
+
+    async def async_uninstall(self):
+        self.uninstall()
+
+    async def async_detect(self) -> bool:
+        return False
+
+    def plan_install(self, plan: Plan) -> None:
+        pass
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        pass
+
+    def script_detect(self, script: Script) -> str:
+        return 'false'
+
+    def script_install(self, script: Script) -> str:
+        return f"printf '%s\\n' {shlex.quote(self.msg)}"
+
+    def script_uninstall(self, script: Script) -> str:
+        return self.script_install(script)
+
 
 class Breakpoint(State):
     """
     State that triggers breakpoints in install, uninstall and detect before entering the encapsulated state.
     """
+    __slots__ = ('target',)
+
     def __init__(self, target: State):
         self.target = target
 
@@ -177,4 +1831,424 @@ class Breakpoint(State):
 
     def detect(self) -> bool:
         breakpoint()
-        return self.target.detect()
+        return self.target.is_installed()
+
+    def children(self) -> tuple[State, ...]:
+        return (self.target,)
+
+    def plan_install(self, plan: Plan) -> None:
+        self.target.plan_install(plan)
+
+    def plan_uninstall(self, plan: Plan) -> None:
+        self.target.plan_uninstall(plan)
+
+    def script_detect(self, script: Script) -> str:
+        # a script has no debugger to break into
+        return script.detect(self.target)
+
+    def script_install(self, script: Script) -> str:
+        return script.ensure(self.target, True)
+
+    def script_uninstall(self, script: Script) -> str:
+        return script.ensure(self.target, False)
+
+
+class Plan:
+    """
+    Actions ensure_installed (or ensure_uninstalled) would perform on a State tree, computed without performing them.
+    Keeps the detect results, so apply(plan) doesn't detect the tree again.
+    """
+    def __init__(self, root: State, uninstall: bool = False, max_workers: int = None):
+        self.root = root
+        self.uninstall = uninstall
+        self.actions: list[tuple[str, State]] = []
+        self._assumed = {}
+        self.run = Run.current() or Run()
+        with self.run:
+            # detect all leafs concurrently, composite States are detected from the memoized results
+            leafs = [s for s in _walk(root) if not s.children()]
+            _concurrently(lambda s: s.is_installed(), leafs, max_workers)
+            self.ensure(root, not uninstall)
+
+    def add(self, action: str, state: State) -> None:
+        self.actions.append((action, state))
+
+    def ensure(self, state: State, installed: bool) -> None:
+        """
+        Records the actions needed for state to become installed or uninstalled, assuming all actions succeed.
+        """
+        current = self._assumed[state] if state in self._assumed else state.is_installed()
+        if current == installed:
+            return
+        if installed:
+            state.plan_install(self)
+        else:
+            state.plan_uninstall(self)
+        self._assumed[state] = installed
+
+    @property
+    def cost(self) -> float:
+        """
+        Estimated seconds needed to apply the plan.
+        """
+        return sum(state.cost for _, state in self.actions)
+
+    def __str__(self) -> str:
+        lines = [f"{action} {state!r}" for action, state in self.actions]
+        lines.append(f"# {len(self.actions)} actions, estimated cost {self.cost:.0f}s")
+        return '\n'.join(lines)
+
+
+def apply(plan: Plan) -> None:
+    """
+    Performs a Plan, reusing the detect results gathered while planning.
+    """
+    with plan.run:
+        if plan.uninstall:
+            plan.root.ensure_uninstalled()
+        else:
+            plan.root.ensure_installed()
+
+
+class Script:
+    """
+    POSIX shell script performing ensure_installed on a State tree in a single shell process, see export_script.
+    Every State becomes shell functions detecting, installing and uninstalling it, built from its script_* methods.
+    Detect results are memoized and invalidated like in a Run.
+    Every State without children reports its outcome on a line 'SG <status> <index> <state>',
+    status is one of ok, installed, absent, uninstalled or failed. The last line is 'SG done <failed>'.
+    """
+    def __init__(self, root: State, sudo: bool = False):
+        """
+        root: State installed by the script
+        sudo: ask for the sudo password once at the start and keep it valid, instead of asking whenever a command needs sudo
+        """
+        self.root = root
+        self.sudo = sudo
+        self._indices = {}
+        self._functions = {}
+        self._pending = []
+        self._main = self.ensure(root, True)
+        while self._pending:
+            self._define(*self._pending.pop(0))
+
+    def index(self, state: State) -> int:
+        """
+        Returns the number of state in the names of its shell functions and variables.
+        """
+        return self._indices.setdefault(state, len(self._indices))
+
+    def _require(self, kind: str, state: State) -> str:
+        name = f"sg_{kind}_{self.index(state)}"
+        if name not in self._functions:
+            self._functions[name] = None
+            self._pending.append((kind, state))
+        return name
+
+    def detect(self, state: State) -> str:
+        """
+        Returns the name of the shell function detecting state.
+        """
+        return self._require('detect', state)
+
+    def ensure(self, state: State, installed: bool) -> str:
+        """
+        Returns the name of the shell function ensuring state is installed or uninstalled, exiting with > 0 on failure.
+        """
+        return self._require('ensure_installed' if installed else 'ensure_uninstalled', state)
+
+    def define(self, name: str, body: str) -> str:
+        """
+        Defines a shell function shared by States, e.g. a package list, once. Returns its name.
+        """
+        self._functions.setdefault(name, body)
+        return name
+
+    def contains(self, name: str, listing: str, key: str) -> str:
+        """
+        Returns shell code exiting with 0 if key is a line printed by the listing command.
+        The listing runs once and is kept until forget(name), it isn't kept if the command fails.
+        """
+        self.define(f"sg_list_{name}", listing)
+        return f"sg_contains {name} {shlex.quote(key)}"
+
+    def forget(self, name: str) -> str:
+        """
+        Returns shell code dropping the kept output of the listing name.
+        """
+        return f"rm -f \"$sg_tmp/{name}\""
+
+    def each(self, calls) -> str:
+        """
+        Returns shell code calling all functions, even after one failed, and failing if one failed.
+        """
+        return '\n'.join(['set -- 0', *(f"{call} || set -- 1" for call in calls), 'return "$1"'])
+
+    def batch(self, states: list[State]) -> str:
+        """
+        Returns shell code ensuring adjacent States sharing a batch_key are installed, with script_install_batch if they have one.
+        """
+        command = type(states[0]).script_install_batch(states, self) if len(states) > 1 else None
+        arguments = [state.script_argument() for state in states]
+        if command is None or None in arguments:
+            return '\n'.join(f"{self.ensure(state, True)} || return 1" for state in states)
+        lines = [f"{self.ensure(required, True)} || return 1" for required in _batch_required(states)]
+        lines += ['set --']
+        for state, argument in zip(states, arguments):
+            n = self.index(state)
+            lines.append(f"sg_batched_{n}=ok; {self.detect(state)} || {{ sg_batched_{n}=installed; set -- \"$@\" {argument}; }}")
+        lines += ['if [ $# -gt 0 ]; then', _indent(command), f"    {self._invalidate(states)}", 'fi']
+        # members the batch failed to install are installed one by one, like install_batch does
+        lines += [f"{self.ensure(state, True)} \"$sg_batched_{self.index(state)}\" || return 1" for state in states]
+        return '\n'.join(lines)
+
+    def _invalidate(self, states: list[State]) -> str:
+        affected = [a for state in states for a in (state, *state.affected())]
+        return f"unset {' '.join(f'sg_detected_{self.index(a)}' for a in dict.fromkeys(affected))}"
+
+    def _hook(self, state: State, kind: str) -> str:
+        code = getattr(state, f"script_{kind}")(self)
+        if code is None:
+            raise Exception(f"{state!r} can't be exported to a shell script: script_{kind} isn't implemented")
+        return code or ':'
+
+    def _define(self, kind: str, state: State) -> None:
+        n = self.index(state)
+        name = f"sg_{kind}_{n}"
+        if kind == 'detect':
+            self._functions[name] = '\n'.join([
+                f"[ -z \"${{sg_detected_{n}-}}\" ] || return \"$sg_detected_{n}\"",
+                '{',
+                _indent(self._hook(state, 'detect')),
+                '} >/dev/null 2>&1',
+                f"sg_detected_{n}=$?",
+                f"return \"$sg_detected_{n}\"",
+            ])
+            return
+        installed = kind == 'ensure_installed'
+        action = 'install' if installed else 'uninstall'
+        self._functions[f"sg_{action}_{n}"] = self._hook(state, action)
+        lines = [f"{self.ensure(required, True)} || return 1" for required in state.required()] if installed else []
+        if state.children():
+            # composite States fail when one of their leafs failed, only the leafs report
+            lines += [
+                f"{'' if installed else '! '}{self.detect(state)} && return 0",
+                f"sg_{action}_{n}",
+                'set -- $?',
+                self._invalidate([state]),
+                'return "$1"',
+            ]
+        else:
+            report = f"sg_report %s {n} {shlex.quote(repr(state))}"
+            # batch passes the status to report if state is already installed
+            found = '"${1:-ok}"' if installed else 'absent'
+            lines += [
+                f"if {'' if installed else '! '}{self.detect(state)}; then",
+                f"    {report % found}",
+                '    return 0',
+                'fi',
+                f"sg_{action}_{n}",
+                'set -- $?',
+                self._invalidate([state]),
+                'if [ "$1" -ne 0 ]; then',
+                f"    {report % 'failed'}",
+                '    return 1',
+                'fi',
+                report % ('installed' if installed else 'uninstalled'),
+            ]
+        self._functions[name] = '\n'.join(lines)
+
+    def __str__(self) -> str:
+        lines = [
+            '#!/bin/sh',
+            f"# generated by SystemGoverner, installs {type(self.root).__name__} with {len(self._indices)} states",
+            'sg_failed=0',
+            'sg_report() {',
+            '    [ "$1" != failed ] || sg_failed=$((sg_failed + 1))',
+            '    printf \'SG %s %s %s\\n\' "$1" "$2" "$3"',
+            '}',
+            'sg_tmp=$(mktemp -d) || exit 1',
+            'trap \'rm -rf "$sg_tmp"; [ -z "${sg_keepalive-}" ] || kill "$sg_keepalive" 2>/dev/null\' EXIT',
+            "trap 'exit 130' INT TERM",
+            'sg_contains() {',
+            '    [ -f "$sg_tmp/$1" ] || "sg_list_$1" > "$sg_tmp/$1" || { rm -f "$sg_tmp/$1"; return 1; }',
+            '    grep -Fxq -- "$2" "$sg_tmp/$1"',
+            '}',
+            'if [ "$(id -u)" -eq 0 ]; then',
+            '    sg_sudo() { "$@"; }',
+        ]
+        if self.sudo:
+            lines += [
+                'else',
+                '    sudo -v || exit 1',
+                '    # keeps the sudo timestamp valid until the script exits',
+                '    while sleep 60; do sudo -n -v || break; done >/dev/null 2>&1 &',
+                '    sg_keepalive=$!',
+                '    sg_sudo() { sudo -n "$@"; }',
+            ]
+        else:
+            lines += ['else', '    sg_sudo() { sudo "$@"; }']
+        lines.append('fi')
+        for name, body in self._functions.items():
+            lines += ['', f"{name}() {{", _indent(body), '}']
+        lines += ['', self._main, 'sg_status=$?', 'printf \'SG done %s\\n\' "$sg_failed"', 'exit "$sg_status"', '']
+        return '\n'.join(lines)
+
+
+def export_script(state: State, sudo: bool = False) -> str:
+    """
+    Compiles ensure_installed of state into a POSIX shell script, running the same detect then install logic
+    in a single shell process, e.g. for first boot provisioning or to bake into an image.
+    Adjacent States of a Chain sharing a batch_key are installed by a single command.
+    Raises an Exception if a State of the tree can't be exported.
+    """
+    return str(Script(state, sudo))
+
+
+def _indent(code: str) -> str:
+    return '\n'.join(f"    {line}" if line else line for line in code.split('\n'))
+
+
+def _units(root: State) -> list[State]:
+    """
+    Returns the States of root in install order with Chain, Parallel and Graph flattened.
+    A State declared twice, e.g. Apt('git') in two sections, is returned once.
+    """
+    units, stack = [], [root]
+    while stack:
+        state = stack.pop()
+        if isinstance(state, Graph):
+            nodes, deps = state.edges()
+            stack.extend(reversed(state._toposort(nodes, deps)))
+        elif isinstance(state, (Chain, Parallel)):
+            stack.extend(reversed(state.states))
+        else:
+            units.append(state)
+    return list({unit.structural_hash(): unit for unit in units}.values())
+
+
+def _uninstall_steps(root: State) -> list[list[State]]:
+    """
+    Returns the steps uninstalling root: its States in reverse dependency order, with Chain, Parallel and Graph
+    flattened, and adjacent batchable States of the same class and batch_key grouped into one step.
+    Only adjacent States are grouped, since moving a member past another State could uninstall something
+    it depends on before it, e.g. the AddAptRepository between two Apt States.
+    """
+    steps, key = [], None
+    for unit in _units(root)[::-1]:
+        k = unit.batch_key()
+        k = None if k is None else (type(unit), k)
+        if steps and k is not None and k == key:
+            steps[-1].append(unit)
+        else:
+            steps.append([unit])
+        key = k
+    return steps
+
+
+def _uninstall(root: State) -> None:
+    with Run.ensure() as run:
+        for step in _uninstall_steps(root):
+            if len(step) == 1:
+                step[0].ensure_uninstalled()
+                continue
+            installed = [s for s in step if s.is_installed()]
+            if not installed:
+                continue
+            try:
+                with run.hold(r for s in installed for r in s.resources()), _Output.labelled(installed):
+                    type(installed[0]).uninstall_batch(installed)
+            finally:
+                run.invalidate(*installed)
+
+
+async def _async_uninstall(root: State) -> None:
+    with Run.ensure() as run:
+        for step in _uninstall_steps(root):
+            if len(step) == 1:
+                await step[0].async_ensure_uninstalled()
+                continue
+            detected = await asyncio.gather(*(s.async_is_installed() for s in step))
+            installed = [s for s, i in zip(step, detected) if i]
+            if not installed:
+                continue
+            try:
+                async with run.async_hold(r for s in installed for r in s.resources()):
+                    with _Output.labelled(installed):
+                        await type(installed[0]).async_uninstall_batch(installed)
+            finally:
+                run.invalidate(*installed)
+
+
+def _walk(state: State):
+    """
+    Yields state and all States encapsulated by it, each once, in depth first order.
+    Uses an explicit stack, so deeply nested trees don't exceed the recursion limit.
+    """
+    stack, seen = [state], set()
+    while stack:
+        state = stack.pop()
+        if state in seen:
+            continue
+        seen.add(state)
+        yield state
+        stack.extend(reversed(state.children()))
+
+
+@functools.cache
+def _signature(cls: type) -> inspect.Signature:
+    return inspect.signature(cls.__init__)
+
+
+def _params(cls: type, args: tuple, kwargs: dict) -> list[str]:
+    """
+    Returns the constructor arguments of a State of cls in identity form, the same however they are passed:
+    bound to the parameters of __init__ with defaults applied, positionally unless they are keyword-only.
+    """
+    signature = _signature(cls)
+    bound = signature.bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    params = []
+    # the first argument is self
+    for name, value in list(bound.arguments.items())[1:]:
+        kind = signature.parameters[name].kind
+        if kind is inspect.Parameter.VAR_POSITIONAL:
+            params += [_identity(v) for v in value]
+        elif kind is inspect.Parameter.VAR_KEYWORD:
+            params += [f"{k}={_identity(v)}" for k, v in sorted(value.items())]
+        elif kind is inspect.Parameter.KEYWORD_ONLY:
+            params.append(f"{name}={_identity(value)}")
+        else:
+            params.append(_identity(value))
+    return params
+
+
+def _declared(existing: tuple, added: tuple, key) -> tuple:
+    """
+    Returns existing extended by the items of added whose key isn't declared yet.
+    Interned States are shared, so building a config again in the same process repeats their declarations.
+    """
+    keys = {key(item) for item in existing}
+    for item in added:
+        if key(item) not in keys:
+            keys.add(key(item))
+            existing += (item,)
+    return existing
+
+
+def _repr_arg(value, depth: int) -> str:
+    if isinstance(value, State):
+        # not repr, which would recurse as deep as the config
+        return value._repr(depth)
+    if isinstance(value, (list, tuple)) and any(isinstance(v, State) for v in value):
+        return f"[{', '.join(_repr_arg(v, depth) for v in value)}]"
+    return repr(value)
+
+
+def _identity(value) -> str:
+    if isinstance(value, State):
+        # a hash instead of the whole identity keeps identities of nested States short
+        return value.structural_hash()
+    if isinstance(value, (list, tuple)):
+        return f"[{', '.join(map(_identity, value))}]"
+    return repr(value)
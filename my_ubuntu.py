@@ -1,200 +1,235 @@
+import argparse
+import os
+
 from lib import *
 from unix import *
 
 
 
 def main():
-    config = Chain(
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-cache', action='store_true', help="detect everything instead of using cached detect results")
+    parser.add_argument('--cache-ttl', type=float, default=24 * 60 * 60, help="seconds a cached detect result stays valid")
+    parser.add_argument('--persistent-shell', action='store_true', help="run all commands in long-lived shells")
+    parser.add_argument('--apt-max-age', type=float, default=AptLists.max_age, help="seconds until the apt package lists are refreshed")
+    parser.add_argument('--trace', metavar='PATH', help="write a Chrome trace of all state calls to PATH and print the slowest states")
+    parser.add_argument('--log', metavar='PATH', help="append the output of all install and uninstall commands to PATH")
+    parser.add_argument('--changed-only', action='store_true', help="only detect states that changed since they were last found installed")
+    parser.add_argument('--full-verify', action='store_true', help="detect every state, even with --changed-only")
+    parser.add_argument('--ssh', metavar='HOST', action='append', default=[], help="converge HOST over ssh instead of this machine, can be repeated")
+    parser.add_argument('--docker', metavar='CONTAINER', action='append', default=[], help="converge the running CONTAINER instead of this machine, can be repeated")
+    parser.add_argument('--hosts', type=int, default=16, help="maximal number of hosts converged at once")
+    parser.add_argument('--watch', action='store_true', help="keep running and reinstall states as soon as their files change")
+    parser.add_argument('--debounce', type=float, default=2.0, help="seconds without file changes before --watch reinstalls")
+    parser.add_argument('--export-script', metavar='PATH', help="write a shell script installing the config to PATH instead of installing it")
+    args = parser.parse_args()
+    Shell.log = args.log
+    AptLists.max_age = args.apt_max_age
+
+    # sections without a declared or implicit dependency between them are installed concurrently
+    apt = Chain(
             Print("\n# install apt packages\n"),
-            Chain(
-                Apt('zsh'),
-                Apt('xclip'),
-                Apt('evince'),
-                # Apt('vim'),
-                Apt('firefox'),
-                Apt('autojump'),
-                Apt('i3'),
-                Apt('xorg'),
-
-                Apt('jq'),
-                Apt('git'),
-                Apt('sed'),
-                Apt('mawk'),
-                Apt('grep'),
-                Apt('tree'),
-                Apt('bat'),
-                Apt('tar'),
-                Apt('zip'),
-                Apt('ripgrep'),
-
-                Apt('nmap'),
-                Apt('dnsutils'),
-                Apt('curl'),
-                Apt('wget'),
-
-                # Apt('maven'),
-                Apt('clang'),
-                Apt('gdb'),
-            ),
+            Apt('zsh'),
+            Apt('xclip'),
+            Apt('evince'),
+            # Apt('vim'),
+            Apt('firefox'),
+            Apt('autojump'),
+            Apt('i3'),
+            Apt('xorg'),
+
+            Apt('jq'),
+            Apt('git'),
+            Apt('sed'),
+            Apt('mawk'),
+            Apt('grep'),
+            Apt('tree'),
+            Apt('bat'),
+            Apt('tar'),
+            Apt('zip'),
+            Apt('ripgrep'),
+
+            Apt('nmap'),
+            Apt('dnsutils'),
+            Apt('curl'),
+            Apt('wget'),
+
+            # Apt('maven'),
+            Apt('clang'),
+            Apt('gdb'),
+
+            Apt('flatpak'),
+        )
 
+    # waits for Apt('flatpak') from the apt section
+    flatpaks = Chain(
             Print("\n# install flatpaks\n"),
-            Chain(
-                Apt('flatpak'),
-                AddFlatpakRemote('flathub', 'https://dl.flathub.org/repo/flathub.flatpakrepo'),
-                #Flatpak('com.google.Chrome'),
-                Flatpak('com.discordapp.Discord'),
-                Flatpak('com.spotify.Client'),
-                Flatpak('org.mozilla.Thunderbird'),
-                Flatpak('net.ankiweb.Anki'),
-                Flatpak('org.kde.kdenlive'),
-                Flatpak('com.github.jeromerobert.pdfarranger'),
-                Flatpak('com.nextcloud.desktopclient.nextcloud'),
-                Flatpak('org.onlyoffice.desktopeditors'),
-                Flatpak('com.mattjakeman.ExtensionManager'),
-                Flatpak('io.github.Qalculate'),
-            ),
+            AddFlatpakRemote('flathub', 'https://dl.flathub.org/repo/flathub.flatpakrepo'),
+            #Flatpak('com.google.Chrome'),
+            Flatpak('com.discordapp.Discord'),
+            Flatpak('com.spotify.Client'),
+            Flatpak('org.mozilla.Thunderbird'),
+            Flatpak('net.ankiweb.Anki'),
+            Flatpak('org.kde.kdenlive'),
+            Flatpak('com.github.jeromerobert.pdfarranger'),
+            Flatpak('com.nextcloud.desktopclient.nextcloud'),
+            Flatpak('org.onlyoffice.desktopeditors'),
+            Flatpak('com.mattjakeman.ExtensionManager'),
+            Flatpak('io.github.Qalculate'),
+        )
 
+    snaps = Chain(
             Print("\n# snap packages\n"),
-            Chain(
-                Snap('drawio'),
-            ),
+            Snap('drawio'),
+        )
 
+    python = Chain(
             Print("\n# setup python env\n"),
-            Chain(
-                    #AddAptRepository('ppa:deadsnakes/ppa'),
-                    #Apt('python3-pip'),
-                    #Apt('python3.12'),
-                    #Apt('python3.12-venv'),
-                    #Apt('python3-full'),
-                    Pip('setuptools', break_system_packages=True),
-                    Pip('ipython', break_system_packages=True),
-                    Pip('ipdb', break_system_packages=True),
-                    Pip('grip', break_system_packages=True),
-                    Pip('docker', break_system_packages=True),
-                    Pip('neovim', break_system_packages=True),
-                    Pip('numpy', break_system_packages=True),
-                    Pip('pandas', break_system_packages=True),
-                    ),
+            #AddAptRepository('ppa:deadsnakes/ppa'),
+            #Apt('python3-pip'),
+            #Apt('python3.12'),
+            #Apt('python3.12-venv'),
+            #Apt('python3-full'),
+            Pip('setuptools', break_system_packages=True),
+            Pip('ipython', break_system_packages=True),
+            Pip('ipdb', break_system_packages=True),
+            Pip('grip', break_system_packages=True),
+            Pip('docker', break_system_packages=True),
+            Pip('neovim', break_system_packages=True),
+            Pip('numpy', break_system_packages=True),
+            Pip('pandas', break_system_packages=True),
+        )
 
+    nvim = Chain(
             Print("\n# setup nvim\n"),
-            Chain(
-                    Print("\n## install nvim\n"),
-                    Command(
-                        Shell('sudo wget https://github.com/neovim/neovim/releases/download/v0.10.3/nvim.appimage -O /usr/local/bin/nvim'),
-                        Shell('sudo rm /usr/local/bin/nvim'),
-                        Shell('test -f /usr/local/bin/nvim'),
-                        ),
-                    Print("\n## clone nvim configuration\n"),
-                    GitClone('git@github.com:DerBrunoIR/NeoVimConfig.git', '~/.config/nvim'),
-                    ),
+            Print("\n## install nvim\n"),
+            Command(
+                Shell('sudo wget https://github.com/neovim/neovim/releases/download/v0.10.3/nvim.appimage -O /usr/local/bin/nvim'),
+                Shell('sudo rm /usr/local/bin/nvim'),
+                FileExists('/usr/local/bin/nvim'),
+                ),
+            Print("\n## clone nvim configuration\n"),
+            GitClone('git@github.com:DerBrunoIR/NeoVimConfig.git', '~/.config/nvim'),
+        ).require(apt)
 
+    dotfiles = Chain(
             Print("\n# install dotfiles\n"),
-            Chain(
-                GitClone('git@github.com:DerBrunoIR/dotfiles.git', '~/dotfiles'),
-                Command(
-                    Shell('yes | ~/dotfiles/install'),
-                    Shell('yes | ~/dotfiles/uninstall'),
-                    Shell('test -f ~/.zshrc'),
-                ),
+            GitClone('git@github.com:DerBrunoIR/dotfiles.git', '~/dotfiles'),
+            Command(
+                Shell('yes | ~/dotfiles/install'),
+                Shell('yes | ~/dotfiles/uninstall'),
+                FileExists('~/.zshrc'),
             ),
+        )
 
-            Print("\n# install sdkman \n"),
+    tools = Parallel(
             Chain(
+                Print("\n# install sdkman \n"),
                 Command(
                     Shell("curl -s 'https://get.sdkman.io' | bash"),
                     Shell("rm -rf ~/.sdkman"),
-                    Shell("test -f ~/.sdkman/bin/sdkman-init.sh"),
+                    FileExists('~/.sdkman/bin/sdkman-init.sh'),
                 ),
             ),
-
-            Print("\n# install golang\n"),
             Chain(
+                Print("\n# install golang\n"),
                 Command(
                     Shell('wget -qO- https://go.dev/dl/go1.20.1.linux-amd64.tar.gz | sudo tar xzf - -C /usr/local '),
                     Shell('sudo rm -rf /usr/local/go'),
-                    Shell('test -d /usr/local/go'),
+                    DirExists('/usr/local/go'),
                     ),
             ),
-
-            Print("\n# ohmyzsh\n"),
             Chain(
+                Print("\n# ohmyzsh\n"),
                 Command(
-                    Shell('sh -c "$(wget https://raw.githubusercontent.com/ohmyzsh/ohmyzsh/master/tools/install.sh -O -)'),
+                    Shell('sh -c "$(wget https://raw.githubusercontent.com/ohmyzsh/ohmyzsh/master/tools/install.sh -O -)"'),
                     Shell("yes | uninstall_oh_my_zsh"),
-                    Shell("test -d ~/.oh-my-zsh"),
+                    DirExists('~/.oh-my-zsh'),
                 ),
             ),
+            max_workers=3,
+        ).require(apt)
 
+    starship = Chain(
             Print("\n# starship prompt\n"),
-            Chain(
-                Print("\n## install starship\n"),
-                From(
-                    Command(
-                        Shell("wget https://starship.rs/install.sh -O /tmp/starship_install.sh && chmod u+x /tmp/starship_install.sh"),
-                        Shell("rm /tmp/starship_install.sh"),
-                        Shell("test -f /tmp/starship_install.sh"),
-                    ), 
-                    Command(
-                        Shell("/tmp/starship_install.sh -y"),
-                        Shell("rm '$(which starship)'"),
-                        Shell("which starship"),
-                    ),
-                ),
-                Print("\n## load starship config\n"),
+            Print("\n## install starship\n"),
+            From(
+                Download('https://starship.rs/install.sh', '/tmp/starship_install.sh', mode=0o755),
                 Command(
-                    Shell('wget https://starship.rs/presets/toml/nerd-font-symbols.toml -O ~/.config/starship.toml'),
-                    Shell('rm ~/.config/starship.toml'),
-                    Shell('test -f ~/.config/starship.toml'),
+                    Shell("/tmp/starship_install.sh -y"),
+                    Shell("rm '$(which starship)'"),
+                    Shell("which starship"),
                 ),
             ),
+            Print("\n## load starship config\n"),
+            Download('https://starship.rs/presets/toml/nerd-font-symbols.toml', '~/.config/starship.toml'),
+        )
 
+    font = Chain(
             Print("\n# install JetBrainsMono nerd font\n"),
-            Chain(
-                From(
-                    Command(
-                        Shell("wget https://github.com/ryanoasis/nerd-fonts/releases/download/v3.2.1/JetBrainsMono.zip -qO /tmp/JetBrainsMono.zip"),
-                        Shell("rm /tmp/JetBrainsMono.zip"),
-                        Shell("test -f /tmp/JetBrainsMono.zip"),
-                    ),
-                    Command(
-                        Shell("unzip /tmp/JetBrainsMono.zip -d ~/.fonts"),
-                        Shell("rm ~/.fonts/JetBrainsMonoNerdFont*.ttf"),
-                        Shell("test -f ~/.fonts/JetBrainsMonoNerdFont-Regular.ttf"),
-                    ),
+            From(
+                Download('https://github.com/ryanoasis/nerd-fonts/releases/download/v3.2.1/JetBrainsMono.zip', '/tmp/JetBrainsMono.zip'),
+                Command(
+                    Shell("unzip /tmp/JetBrainsMono.zip -d ~/.fonts"),
+                    Shell("rm ~/.fonts/JetBrainsMonoNerdFont*.ttf"),
+                    FileExists('~/.fonts/JetBrainsMonoNerdFont-Regular.ttf'),
                 ),
             ),
+        )
 
+    # apt and dpkg installs are serialized by the 'dpkg-lock' resource
+    bat = Chain(
             Print("\n# install bat \n"),
-            Chain(
-                Apt('bat'),
-                Command(
-                    Shell('sudo ln -s /bin/batcat /bin/bat'),
-                    Shell('sudo rm /bin/bat'),
-                    Shell('test -L /bin/bat'),
-                ),
+            Apt('bat'),
+            Command(
+                Shell('sudo ln -s /bin/batcat /bin/bat'),
+                Shell('sudo rm /bin/bat'),
+                SymlinkTo('/bin/bat', '/bin/batcat'),
             ),
+        )
 
+    pandoc = Chain(
             Print("\n# install pandoc \n"),
             From(
-                Command(
-                    Shell('wget https://github.com/jgm/pandoc/releases/download/3.6.1/pandoc-3.6.1-1-amd64.deb -qO /tmp/pandoc.deb'),
-                    Shell('rm /tmp/pandoc.deb'),
-                    Shell('test -f /tmp/pandoc.deb'),
-                ),
+                Download('https://github.com/jgm/pandoc/releases/download/3.6.1/pandoc-3.6.1-1-amd64.deb', '/tmp/pandoc.deb'),
                 Dpkg('pandoc', '/tmp/pandoc.deb'),
             ),
+        )
 
+    link_flatpaks = Chain(
             Print("\n# Link flatpaks to /usr/bin/\n"),
-            Chain(
-                Command(
-                    Shell("yes | ~/dotfiles/link-flatpaks.sh"),
-                    Shell("yes | ~/dotfiles/unlink-flatpaks.sh"),
-                    Shell("test -f ~/.profile"),
-                ),
+            Command(
+                Shell("yes | ~/dotfiles/link-flatpaks.sh"),
+                Shell("yes | ~/dotfiles/unlink-flatpaks.sh"),
+                FileExists('~/.profile'),
             ),
-        )
-
-    config.ensure_installed()
+        ).require(flatpaks, dotfiles)
+
+    config = Graph(apt, flatpaks, snaps, python, nvim, dotfiles, tools, starship, font, bat, pandoc, link_flatpaks, width=4)
+
+    if args.export_script:
+        with open(args.export_script, 'w') as f:
+            f.write(export_script(config, sudo=True))
+        os.chmod(args.export_script, 0o755)
+        return
+
+    if args.ssh or args.docker:
+        backends = {host: SshBackend(host) for host in args.ssh} | {container: DockerBackend(container) for container in args.docker}
+        results = Fleet(backends, limit=args.hosts).ensure_installed(config)
+        print(Fleet.report(results))
+        raise SystemExit(0 if all(r.ok for r in results) else 1)
+
+    cache = None if args.no_cache else DetectCache(ttl=args.cache_ttl)
+    backend = PersistentShellBackend() if args.persistent_shell else SubprocessBackend()
+    tracer = Tracer(args.trace) if args.trace else None
+    converged = ConvergeLog(trust=args.changed_only and not args.full_verify)
+    if args.watch:
+        with backend:
+            Watcher(config, debounce=args.debounce).watch()
+        return
+
+    with backend, Run(cache=cache, tracer=tracer, converged=converged):
+        config.ensure_installed()
 
 
 
@@ -0,0 +1,155 @@
+"""
+Download against a local http.server stand-in, which resets the connection in the middle of the body.
+Run with: python -m unittest test_download
+"""
+import hashlib
+import http.server
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from lib import Parallel, Run
+from unix import Download
+
+
+DATA = bytes(range(256)) * (3_000_000 // 256) + b'x' * (3_000_000 % 256)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # bytes sent before the connection is broken off, per request, until the list is used up
+    resets: list[int] = []
+    # reset the connection, discarding what the client didn't read yet, instead of closing it
+    hard: bool = False
+    ranges: list[str] = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        type(self).ranges.append(header)
+        offset = int(header.removeprefix('bytes=').removesuffix('-')) if header else 0
+        if offset >= len(DATA):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if offset else 200)
+        if offset:
+            self.send_header('Content-Range', f"bytes {offset}-{len(DATA) - 1}/{len(DATA)}")
+        self.send_header('Content-Length', str(len(DATA) - offset))
+        self.end_headers()
+        if not type(self).resets:
+            self.wfile.write(DATA[offset:])
+            return
+        self.wfile.write(DATA[offset:offset + type(self).resets.pop(0)])
+        if type(self).hard:
+            # closing with a zero linger timeout sends a RST instead of a FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/file.bin"
+        Handler.resets = []
+        Handler.ranges = []
+        Handler.hard = False
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def download(self, dest: str = 'dest.bin', **kwargs) -> Download:
+        return Download(self.url, os.path.join(self.tmp.name, dest), cache=os.path.join(self.tmp.name, 'cache'), **kwargs)
+
+    def read(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_resumes_after_close(self):
+        Handler.resets = [1_000_000, 500_000]
+        download = self.download()
+        with Run():
+            download.ensure_installed()
+        self.assertEqual(self.read(download.dest), DATA)
+        self.assertEqual(Handler.ranges, ['bytes=0-', 'bytes=1000000-', 'bytes=1500000-'])
+
+    def test_resumes_after_reset(self):
+        # how much of the body arrives before the reset depends on the kernel, the file must be complete anyway
+        Handler.resets = [1_000_000, 1_000_000]
+        Handler.hard = True
+        download = self.download()
+        with Run():
+            download.ensure_installed()
+        self.assertEqual(self.read(download.dest), DATA)
+        self.assertEqual(len(Handler.ranges), 3)
+
+    def test_resumes_after_reset_with_checksum(self):
+        Handler.resets = [1_000_000]
+        Handler.hard = True
+        download = self.download(sha256=hashlib.sha256(DATA).hexdigest())
+        with Run():
+            download.ensure_installed()
+            self.assertTrue(download.detect())
+        self.assertEqual(self.read(download.dest), DATA)
+
+    def test_gives_up_after_retries(self):
+        Handler.resets = [100_000] * (Download.retries + 1)
+        download = self.download()
+        with Run(), self.assertRaises(Exception):
+            download.ensure_installed()
+        self.assertFalse(os.path.exists(download.dest))
+        # the next run resumes from what was received so far
+        with Run():
+            download.ensure_installed()
+        self.assertEqual(self.read(download.dest), DATA)
+        self.assertEqual(Handler.ranges[-1], f"bytes={100_000 * (Download.retries + 1)}-")
+
+    def test_cached(self):
+        download = self.download()
+        with Run():
+            download.ensure_installed()
+        os.remove(download.dest)
+        with Run():
+            download.ensure_installed()
+        self.assertEqual(self.read(download.dest), DATA)
+        self.assertEqual(len(Handler.ranges), 1)
+
+    def test_concurrent_downloads_of_same_url(self):
+        Handler.resets = [1_000_000]
+        downloads = [self.download(f"dest{i}.bin") for i in range(4)]
+        with Run():
+            Parallel(*downloads).ensure_installed()
+        for download in downloads:
+            self.assertEqual(self.read(download.dest), DATA)
+
+    def test_damaged_cache_is_downloaded_again(self):
+        download = self.download(sha256=hashlib.sha256(DATA).hexdigest())
+        with Run():
+            download.ensure_installed()
+        with open(download._cached_blob(), 'r+b') as f:
+            f.write(b'damaged')
+        os.remove(download.dest)
+        with Run():
+            download.ensure_installed()
+        self.assertEqual(self.read(download.dest), DATA)
+        self.assertEqual(len(Handler.ranges), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Fleet against FakeBackend hosts, whose commands change an in-memory system instead of a real one.
+Run with: python -m unittest test_fleet
+"""
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from bench import FakeBackend
+from lib import Chain, Graph, captured_output
+from unix import AddFlatpakRemote, Apt, Fleet, Flatpak, Pip
+
+
+def config():
+    return Graph(
+        Apt('flatpak'),
+        AddFlatpakRemote('flathub', 'https://dl.flathub.org/repo/flathub.flatpakrepo'),
+        Flatpak('com.spotify.Client'),
+        Chain(Apt('git'), Apt('python3-pip'), Pip('requests')),
+    )
+
+
+class BrokenApt(FakeBackend):
+    """
+    Host whose apt can't install anything.
+    """
+    def _execute(self, argv: list[str]) -> tuple[int, str]:
+        if argv[:2] == ['apt', 'install']:
+            return 100, ''
+        return super()._execute(argv)
+
+
+class FleetTest(unittest.TestCase):
+    def converge(self, fleet: Fleet):
+        async def main():
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=fleet.threads))
+            # a deadlock fails the test instead of hanging it
+            return await asyncio.wait_for(fleet.async_ensure_installed(config()), 30)
+        with captured_output():
+            return asyncio.run(main())
+
+    def test_converges_all_hosts(self):
+        backends = {f"host{i}": FakeBackend(latency={}, default_latency=0.005) for i in range(20)}
+        results = self.converge(Fleet(backends, limit=20, threads=2))
+        self.assertTrue(all(r.ok for r in results), Fleet.report(results))
+        for backend in backends.values():
+            self.assertEqual(backend.debs, {'flatpak', 'git', 'python3-pip'})
+            self.assertEqual(backend.flatpaks, {('com.spotify.Client', 'user')})
+            self.assertEqual(backend.pips, {'requests'})
+
+    def test_failed_host_doesnt_stop_others(self):
+        backends = {'ok': FakeBackend(latency={}, default_latency=0.0), 'broken': BrokenApt(latency={}, default_latency=0.0)}
+        results = {r.host: r for r in self.converge(Fleet(backends, threads=4))}
+        self.assertTrue(results['ok'].ok)
+        self.assertFalse(results['broken'].ok)
+        self.assertEqual(backends['ok'].pips, {'requests'})
+        self.assertEqual(backends['broken'].debs, set())
+
+    def test_graph_uses_no_thread_pool_per_host(self):
+        backends = {f"host{i}": FakeBackend(latency={}, default_latency=0.0) for i in range(5)}
+        with mock.patch('lib.ThreadPoolExecutor', side_effect=AssertionError("thread pool per host")):
+            results = self.converge(Fleet(backends, threads=2))
+        self.assertTrue(all(r.ok for r in results), Fleet.report(results))
+
+    def test_second_run_installs_nothing(self):
+        backends = {'host': FakeBackend(latency={}, default_latency=0.0)}
+        self.converge(Fleet(backends, threads=2))
+        commands = backends['host'].commands
+        debs = set(backends['host'].debs)
+        results = self.converge(Fleet(backends, threads=2))
+        self.assertTrue(results[0].ok)
+        self.assertEqual(backends['host'].debs, debs)
+        self.assertLess(backends['host'].commands - commands, commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Output sizes recorded by Tracer, for captured and streamed commands run against FakeBackend.
+Run with: python -m unittest test_trace
+"""
+import unittest
+from unittest import mock
+
+from bench import FakeBackend
+from lib import Run, Tracer, captured_output
+from unix import Shell, StreamedOutput
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBackend(latency={}, default_latency=0.0)
+        self.backend.pips = {f"package{i}" for i in range(100)}
+        # what 'pip list' prints on the fake system
+        self.size = len(self.backend._execute(['pip', 'list'])[1])
+
+    def traced(self, capture: bool):
+        tracer = Tracer(top=0)
+        with captured_output(), self.backend.use(), Run(tracer=tracer), tracer.span('pip', 'detect') as span:
+            r = Shell('pip list').run(capture=capture)
+        return span, r
+
+    def test_streamed_chunks_are_counted(self):
+        output = StreamedOutput('cmd', limit=10, echo=False)
+        for _ in range(3):
+            output.write(1, b'x' * 8)
+        output.write(2, b'error\n')
+        r = output.result(0)
+        self.assertEqual(output.sizes, {1: 24, 2: 6})
+        self.assertEqual(len(r.stdout), 10)
+
+    def test_captured_output_size(self):
+        span, r = self.traced(capture=True)
+        self.assertEqual(span.stdout, self.size)
+        self.assertEqual(len(r.stdout), self.size)
+
+    def test_streamed_output_size_beyond_tail(self):
+        with mock.patch.object(Shell, 'tail_limit', 100):
+            span, r = self.traced(capture=False)
+        self.assertEqual(len(r.stdout), 100)
+        self.assertEqual(span.stdout, self.size)
+        self.assertEqual(span.exit_codes, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Watcher against files of a temporary directory, watched with inotify.
+Run with: python -m unittest test_watch
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from lib import Chain, captured_output
+from unix import Command, FileExists, Inotify, Shell, Watcher
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        output = captured_output()
+        output.__enter__()
+        self.addCleanup(output.__exit__, None, None, None)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmp.name, name)
+
+    def file(self, name: str) -> Command:
+        path = self.path(name)
+        return Command(install=Shell(f"touch '{path}'"), uninstall=Shell(f"rm '{path}'"), detect=FileExists(path))
+
+    def watcher(self, *names: str, debounce: float = 0.2, max_delay: float = 5.0) -> Watcher:
+        watcher = Watcher(Chain(*map(self.file, names)), debounce=debounce, max_delay=max_delay)
+        watcher._inotify = Inotify()
+        self.addCleanup(watcher._inotify.close)
+        watcher._sync()
+        return watcher
+
+    def touch_repeatedly(self, name: str, times: int, interval: float) -> list[float]:
+        """
+        Appends to the file name times in a thread, and returns the list the time of every write is appended to.
+        """
+        written = []
+        def touch():
+            for _ in range(times):
+                time.sleep(interval)
+                with open(self.path(name), 'a') as f:
+                    f.write('x')
+                written.append(time.monotonic())
+        thread = threading.Thread(target=touch)
+        thread.start()
+        self.addCleanup(thread.join)
+        return written
+
+    def test_inotify_reports_changed_entries(self):
+        inotify = Inotify()
+        self.addCleanup(inotify.close)
+        inotify.watch(self.tmp.name)
+        self.assertEqual(inotify.read(0), [])
+        open(self.path('a'), 'w').close()
+        self.assertIn(self.path('a'), inotify.read(1))
+
+    def test_debounce_waits_for_changes_to_stop(self):
+        watcher = self.watcher('a')
+        written = self.touch_repeatedly('a', 5, 0.05)
+        changed = watcher._wait()
+        returned = time.monotonic()
+        # all changes are reported by a single wait, which returns once they stopped for debounce seconds
+        self.assertEqual(len(written), 5)
+        self.assertEqual(set(changed), {self.path('a')})
+        self.assertEqual(watcher._inotify.read(0), [])
+        self.assertGreaterEqual(returned - written[-1], watcher.debounce - 0.01)
+
+    def test_max_delay_bounds_continuous_changes(self):
+        watcher = self.watcher('a', debounce=0.2, max_delay=0.4)
+        self.touch_repeatedly('a', 20, 0.05)
+        start = time.monotonic()
+        changed = watcher._wait()
+        self.assertIn(self.path('a'), changed)
+        self.assertLess(time.monotonic() - start, 0.8)
+
+    def test_reconverges_only_affected_states(self):
+        watcher = self.watcher('a', 'b')
+        with watcher.run():
+            watcher.root.ensure_installed()
+        # the changes made by installing
+        self.assertEqual(watcher.affected(watcher._wait()), [self.file('a'), self.file('b')])
+        b = os.stat(self.path('b')).st_mtime_ns
+        os.remove(self.path('a'))
+        units = watcher.affected(watcher._wait())
+        self.assertEqual(units, [self.file('a')])
+        watcher.reconverge(units)
+        self.assertTrue(os.path.exists(self.path('a')))
+        self.assertEqual(os.stat(self.path('b')).st_mtime_ns, b)
+        # reconverging is reported by inotify too, the next reconvergence only detects it
+        units = watcher.affected(watcher._wait())
+        self.assertEqual(units, [self.file('a')])
+        watcher.reconverge(units)
+        self.assertEqual(watcher._inotify.read(0.3), [])
+
+    def test_reconverges_created_directory(self):
+        watcher = self.watcher('dir/a')
+        os.mkdir(self.path('dir'))
+        units = watcher.affected(watcher._wait())
+        watcher._sync()
+        self.assertEqual(units, [self.file('dir/a')])
+        watcher.reconverge(units)
+        self.assertTrue(os.path.exists(self.path('dir/a')))
+        # the created directory is watched from now on
+        os.remove(self.path('dir/a'))
+        self.assertEqual(watcher.affected(watcher._wait()), [self.file('dir/a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,34 @@
 from __future__ import annotations
 
+import asyncio
+import ctypes
+import fcntl
 import subprocess
+import hashlib
+import http.client
+import json
 import os
+import re
 import pwd
+import secrets
+import selectors
+import shlex
+import shutil
+import site
+import struct
+import sysconfig
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cache
+from urllib.parse import urljoin, urlsplit
 from typing import Callable
 from io import IOBase
 
-from lib import State, Try, Invert
+from lib import State, Try, Invert, Run, Tracer, Script, print_live, captured_output, _units, _walk
 
 
 
@@ -19,6 +40,18 @@ class Runnable(ABC):
         """
         pass
 
+    async def run_async(self, *args, **kwargs) -> any:
+        """
+        Asynchronous version of run, runs run in a thread unless overridden.
+        """
+        return await asyncio.to_thread(self.run, *args, **kwargs)
+
+    def script(self) -> str | None:
+        """
+        Returns the equivalent shell code for export_script, None if there is none.
+        """
+        return None
+
 class AnsiColor:
     """ ANSI color codes """
     BLACK = "\033[0;30m"
@@ -47,16 +80,560 @@ class AnsiColor:
     END = "\033[0m"
 
 
+def _expand(text: str) -> str:
+    """
+    Expands '~' and environment variables like Shell.run does.
+    """
+    return os.path.expandvars(text.replace('~', '$HOME'))
+
+
+def _script_home(cmd: str) -> str:
+    """
+    Replaces '~' with $HOME like Shell.run does, but expanded by the shell running an exported script.
+    """
+    # quoting context of every open quote or command substitution, None is unquoted
+    out, stack, escaped = [], [None], False
+    i = 0
+    while i < len(cmd):
+        c, quote = cmd[i], stack[-1]
+        if escaped:
+            escaped = False
+        elif quote == "'":
+            if c == "'":
+                stack.pop()
+            elif c == '~':
+                c = "'\"$HOME\"'"
+        elif c == '\\':
+            escaped = True
+        elif cmd.startswith('$(', i):
+            stack.append(None)
+            c, i = '$(', i + 1
+        elif c == ')' and quote is None and len(stack) > 1:
+            stack.pop()
+        elif c == '"':
+            stack.pop() if quote == '"' else stack.append('"')
+        elif c == "'" and quote is None:
+            stack.append("'")
+        elif c == '~':
+            c = '$HOME' if quote == '"' else '"$HOME"'
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+@cache
+def _process_owner() -> str:
+    return pwd.getpwuid(os.getuid()).pw_name
+
+
+class StreamedOutput:
+    """
+    Receives the output of a command while it runs.
+    Prints complete lines live, keeps only the last limit bytes of stdout and stderr for error messages
+    and appends everything to an optional log file.
+    """
+    # seconds between two printed progress lines, i.e. lines ending with a carriage return
+    progress_interval = 1.0
+
+    def __init__(self, cmd: str, limit: int = 64 * 1024, log: str = None, echo: bool = True):
+        """
+        cmd: the running command
+        limit: bytes of stdout and of stderr kept for the result
+        log: file the output is appended to, not logged if None
+        echo: print the output live
+        """
+        self.cmd = cmd
+        self.limit = limit
+        self.log = log
+        self.echo = echo
+        self._tails = {1: bytearray(), 2: bytearray()}
+        self._partial = {1: b'', 2: b''}
+        # bytes received on stdout and stderr, the tails keep only the last limit of them
+        self.sizes = {1: 0, 2: 0}
+        self._file = None
+        self._progress = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, fd: int, data: bytes) -> None:
+        """
+        Adds data read from stdout (fd 1) or stderr (fd 2).
+        """
+        if not data:
+            return
+        with self._lock:
+            self.sizes[fd] += len(data)
+            tail = self._tails[fd]
+            tail += data
+            del tail[:-self.limit]
+            if self.log is not None:
+                if self._file is None:
+                    self._file = open(os.path.expanduser(self.log), 'ab')
+                    self._file.write(f"$ {self.cmd}\n".encode())
+                self._file.write(data)
+            if self.echo:
+                self._print(fd, data)
+
+    def _print(self, fd: int, data: bytes) -> None:
+        *lines, partial = re.split(rb'(?<=\r(?!\n))|(?<=\n)', self._partial[fd] + data)
+        if len(partial) > self.limit:
+            lines, partial = lines + [partial], b''
+        self._partial[fd] = partial
+        for line in lines:
+            if line.endswith(b'\r'):
+                # progress bars redraw their line, show them only every progress_interval seconds
+                now = time.monotonic()
+                if now - self._progress < self.progress_interval:
+                    continue
+                self._progress = now
+            text = line.rstrip(b'\r\n').decode(errors='replace')
+            if text:
+                print_live(text)
+
+    def result(self, returncode: int) -> subprocess.CompletedProcess:
+        """
+        Ends the output and returns it with the kept tails of stdout and stderr.
+        """
+        with self._lock:
+            if self.echo:
+                for fd, partial in self._partial.items():
+                    if partial.strip():
+                        print_live(partial.rstrip(b'\r\n').decode(errors='replace'))
+                    self._partial[fd] = b''
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        return subprocess.CompletedProcess(self.cmd, returncode, bytes(self._tails[1]), bytes(self._tails[2]))
+
+
+class Backend(ABC):
+    """
+    Executes the commands of Shell.run.
+    The backend of the current context is used, SubprocessBackend by default.
+    Use as context manager to make it the current backend and close it afterwards.
+    """
+    _current: ContextVar = ContextVar('backend', default=None)
+    # commands run on this machine, so in-process file checks and downloads see the same files
+    local: bool = True
+
+    def owner(self) -> str:
+        """
+        Returns the user commands run as by default.
+        """
+        return _process_owner()
+
+    def cwd(self) -> str:
+        """
+        Returns the directory commands run in by default.
+        """
+        return os.getcwd()
+
+    def expand(self, text: str) -> str:
+        """
+        Expands '~' and environment variables of a command like the shell of the backend would, also within quotes.
+        """
+        return _expand(text)
+
+    @abstractmethod
+    def execute(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        """
+        Runs the expanded shell command cmd in directory cwd as user, with sudo if requested.
+        Returns the exit code and the captured stdout and stderr.
+        output: receives stdout and stderr while the command runs, the result holds output.result() instead of the full output
+        """
+        pass
+
+    async def execute_async(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        """
+        Asynchronous version of execute, runs execute in a thread unless overridden.
+        """
+        return await asyncio.to_thread(self.execute, cmd, cwd, user, sudo, output)
+
+    def close(self) -> None:
+        """
+        Releases resources held by the backend.
+        """
+        pass
+
+    @classmethod
+    def current(cls) -> Backend:
+        return cls._current.get() or _default_backend
+
+    @contextmanager
+    def use(self):
+        """
+        Makes this backend the current backend within the with block.
+        """
+        token = self._current.set(self)
+        try:
+            yield self
+        finally:
+            self._current.reset(token)
+
+    def __enter__(self) -> Backend:
+        self._use = self.use()
+        self._use.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._use.__exit__(*exc)
+        self.close()
+
+
+class SubprocessBackend(Backend):
+    """
+    Runs every command in a new shell process.
+    """
+    def execute(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        if output is None:
+            return subprocess.run(
+                    "sudo " + cmd if sudo else cmd,
+                    capture_output=True,
+                    cwd=cwd,
+                    user=user,
+                    shell=True,
+                )
+        process = subprocess.Popen(
+                "sudo " + cmd if sudo else cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                user=user,
+                shell=True,
+            )
+        return _stream(process, output)
+
+    async def execute_async(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        cmd = "sudo " + cmd if sudo else cmd
+        process = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=cwd,
+                user=user,
+            )
+        return await _async_stream(cmd, process, output)
+
+
+def _stream(process: subprocess.Popen, output: StreamedOutput) -> subprocess.CompletedProcess:
+    """
+    Hands stdout and stderr of process to output until it exits.
+    """
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, 1)
+        selector.register(process.stderr, selectors.EVENT_READ, 2)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fileobj.fileno(), 1 << 16)
+                if chunk:
+                    output.write(key.data, chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    process.stdout.close()
+    process.stderr.close()
+    return output.result(process.wait())
+
+
+async def _async_stream(cmd, process: asyncio.subprocess.Process, output: StreamedOutput | None) -> subprocess.CompletedProcess:
+    """
+    Asynchronous version of _stream, captures the entire output without output.
+    """
+    if output is None:
+        stdout, stderr = await process.communicate()
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    async def forward(stream, fd: int):
+        while chunk := await stream.read(1 << 16):
+            output.write(fd, chunk)
+
+    await asyncio.gather(forward(process.stdout, 1), forward(process.stderr, 2))
+    return output.result(await process.wait())
+
+
+_default_backend = SubprocessBackend()
+
+
+class RemoteBackend(Backend):
+    """
+    Runs every command on another machine or container, through a local client process per command.
+    Subclasses return the client command line.
+    """
+    local = False
+
+    def __init__(self):
+        self._probed = None
+        self._probe_lock = threading.Lock()
+
+    @abstractmethod
+    def argv(self, cmd: str, cwd: str | None, user: str | None, sudo: bool) -> list[str]:
+        """
+        Returns the local command line running cmd on the remote side, in cwd as user, with sudo if requested.
+        cwd and user are None for the defaults of the remote side.
+        """
+        pass
+
+    def _probe(self) -> tuple[str, str]:
+        # user and home directory of the remote side, asked once, blocks until the remote side answered
+        with self._probe_lock:
+            if self._probed is None:
+                r = subprocess.run(self.argv('id -un; printf "%s\\n" "$HOME"', None, None, False), capture_output=True, stdin=subprocess.DEVNULL)
+                lines = r.stdout.decode().splitlines()
+                if r.returncode != 0 or len(lines) < 2:
+                    raise Exception(f"failed to reach {self!r}. \nstderr: {r.stderr.decode()}")
+                self._probed = (lines[0], lines[1])
+            return self._probed
+
+    def owner(self) -> str:
+        return self._probe()[0]
+
+    def cwd(self) -> str:
+        return self._probe()[1]
+
+    def expand(self, text: str) -> str:
+        # environment variables are expanded by the remote shell
+        return text.replace('~', self._probe()[1])
+
+    def _args(self, cwd: str, user: str) -> tuple[str | None, str | None]:
+        return (None if cwd == self.cwd() else cwd), (None if user == self.owner() else user)
+
+    def execute(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        argv = self.argv(cmd, *self._args(cwd, user), sudo)
+        if output is None:
+            r = subprocess.run(argv, capture_output=True, stdin=subprocess.DEVNULL)
+            return subprocess.CompletedProcess(cmd, r.returncode, r.stdout, r.stderr)
+        process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return _stream(process, output)
+
+    async def execute_async(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        process = await asyncio.create_subprocess_exec(
+                *self.argv(cmd, *self._args(cwd, user), sudo),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        return await _async_stream(cmd, process, output)
+
+
+class SshBackend(RemoteBackend):
+    """
+    Runs commands on a host over ssh.
+    All commands share one multiplexed connection (ControlMaster), which is closed with the backend.
+    """
+    def __init__(self, host: str, user: str = None, port: int = None, options: tuple[str, ...] = (), control_path: str = '~/.ssh/systemgoverner-%C'):
+        """
+        host: host name or alias of ~/.ssh/config
+        user: login user, ssh's default if None
+        port: ssh port, ssh's default if None
+        options: additional ssh arguments, e.g. ('-i', '~/.ssh/fleet')
+        control_path: socket of the shared connection, %C is replaced by a hash of the connection
+        """
+        super().__init__()
+        self.host = host
+        self.user = user
+        self.port = port
+        self.options = tuple(options)
+        self.control_path = os.path.expanduser(control_path)
+
+    def __repr__(self) -> str:
+        return f"SshBackend({self.host!r})"
+
+    def _ssh(self) -> list[str]:
+        argv = [
+            'ssh',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={self.control_path}",
+            '-o', 'ControlPersist=60',
+        ]
+        if self.user is not None:
+            argv += ['-l', self.user]
+        if self.port is not None:
+            argv += ['-p', str(self.port)]
+        return argv + list(self.options)
+
+    def argv(self, cmd: str, cwd: str | None, user: str | None, sudo: bool) -> list[str]:
+        script = cmd if cwd is None else f"cd {shlex.quote(cwd)} && {cmd}"
+        if sudo or user is not None:
+            wrapper = ['sudo'] + (['-u', user] if user is not None else []) + ['sh', '-c', script]
+            script = ' '.join(map(shlex.quote, wrapper))
+        return self._ssh() + [self.host, '--', script]
+
+    def close(self) -> None:
+        subprocess.run(self._ssh() + ['-O', 'exit', self.host], capture_output=True, stdin=subprocess.DEVNULL)
+
+
+class DockerBackend(RemoteBackend):
+    """
+    Runs commands in a running container with 'docker exec', or any engine with the same interface like podman.
+    """
+    def __init__(self, container: str, user: str = None, engine: str = 'docker'):
+        """
+        container: name or id of the container
+        user: user commands run as, the container's default if None
+        engine: container engine binary
+        """
+        super().__init__()
+        self.container = container
+        self.user = user
+        self.engine = engine
+
+    def __repr__(self) -> str:
+        return f"DockerBackend({self.container!r})"
+
+    def argv(self, cmd: str, cwd: str | None, user: str | None, sudo: bool) -> list[str]:
+        argv = [self.engine, 'exec']
+        if cwd is not None:
+            argv += ['-w', cwd]
+        # containers usually lack sudo, root is selected by exec instead
+        user = 'root' if sudo else user or self.user
+        if user is not None:
+            argv += ['-u', user]
+        return argv + [self.container, 'sh', '-c', cmd]
+
+
+class _ShellWorker:
+    """
+    Long-lived /bin/sh reading commands from its stdin.
+    Output and exit code of each command are followed by a random sentinel line on stdout and stderr.
+    """
+    def __init__(self, user: str, sudo: bool):
+        self.process = subprocess.Popen(
+                ['sudo', '/bin/sh'] if sudo else ['/bin/sh'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                user=user,
+            )
+
+    # more bytes than a sentinel line, held back from streamed output until the sentinel can't start in them
+    _HOLD = 64
+
+    def _read_until(self, markers: dict, output: StreamedOutput = None) -> dict:
+        """
+        Reads stdout and stderr until each ends with its marker, returns the data read per stream.
+        With output, the data is forwarded as it arrives and only the not yet forwarded rest is returned.
+        """
+        data = {stream: b'' for stream in markers}
+        fds = {self.process.stdout: 1, self.process.stderr: 2}
+        pending = set(markers)
+        with selectors.DefaultSelector() as selector:
+            for stream in markers:
+                selector.register(stream, selectors.EVENT_READ)
+            while pending:
+                for key, _ in selector.select():
+                    chunk = os.read(key.fileobj.fileno(), 1 << 16)
+                    if not chunk:
+                        raise Exception(f"persistent shell exited with code {self.process.wait()}")
+                    data[key.fileobj] += chunk
+                    if markers[key.fileobj].search(data[key.fileobj]):
+                        pending.discard(key.fileobj)
+                        selector.unregister(key.fileobj)
+                    elif output is not None and len(data[key.fileobj]) > self._HOLD:
+                        output.write(fds[key.fileobj], data[key.fileobj][:-self._HOLD])
+                        data[key.fileobj] = data[key.fileobj][-self._HOLD:]
+        return data
+
+    def execute(self, cmd: str, cwd: str, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        token = secrets.token_hex(16)
+        # the command runs in a subshell, so 'exit' or 'cd' don't affect the worker
+        script = (
+            f"(cd {shlex.quote(cwd)} && eval {shlex.quote(cmd)}) </dev/null\n"
+            f"printf '\\n{token} %d\\n' $?\n"
+            f"printf '\\n{token}\\n' >&2\n"
+        )
+        self.process.stdin.write(script.encode())
+        self.process.stdin.flush()
+        out, err = self.process.stdout, self.process.stderr
+        stdout_marker = re.compile(rb'\n' + token.encode() + rb' (\d+)\n$')
+        stderr_marker = re.compile(rb'\n' + token.encode() + rb'\n$')
+        data = self._read_until({out: stdout_marker, err: stderr_marker}, output)
+        match = stdout_marker.search(data[out])
+        if output is not None:
+            output.write(1, data[out][:match.start()])
+            output.write(2, data[err][:stderr_marker.search(data[err]).start()])
+            return output.result(int(match.group(1)))
+        return subprocess.CompletedProcess(
+                cmd,
+                int(match.group(1)),
+                data[out][:match.start()],
+                data[err][:stderr_marker.search(data[err]).start()],
+            )
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class PersistentShellBackend(Backend):
+    """
+    Runs commands in long-lived shells, one pool of shells per (user, sudo) pair.
+    Saves the process start, and sudo's authentication and session setup, of every command.
+    """
+    def __init__(self):
+        self._idle = {}
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def execute(self, cmd: str, cwd: str, user: str, sudo: bool, output: StreamedOutput = None) -> subprocess.CompletedProcess:
+        key = (user, sudo)
+        with self._lock:
+            idle = self._idle.get(key)
+            worker = idle.pop() if idle else None
+        if worker is None:
+            worker = _ShellWorker(user, sudo)
+            with self._lock:
+                self._workers.append(worker)
+        try:
+            r = worker.execute(cmd, cwd, output)
+        except BaseException:
+            # the worker is in an unknown state, don't reuse it
+            with self._lock:
+                self._workers.remove(worker)
+            worker.process.kill()
+            raise
+        with self._lock:
+            self._idle.setdefault(key, []).append(worker)
+        return r
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers, self._idle = self._workers, [], {}
+        for worker in workers:
+            worker.close()
+
+
 class Shell(Runnable):
     """
     Can build and run shell commands.
     """
+    # default of capture while no streaming() block is active
+    _capture: ContextVar = ContextVar('shell_capture', default=True)
+    # bytes of stdout and stderr kept of streamed commands
+    tail_limit: int = 64 * 1024
+    # file the output of streamed commands is appended to, not logged if None
+    log: str = None
+
     def __init__(self, cmd: str):
         self.cmd = cmd
 
     def __repr__(self) -> str:
         return f"<Shell '{self.cmd:5}'>"
 
+    @classmethod
+    @contextmanager
+    def streaming(cls):
+        """
+        Streams the output of Shell commands run within the with block, unless they pass capture.
+        """
+        token = cls._capture.set(False)
+        try:
+            yield
+        finally:
+            cls._capture.reset(token)
+
+    def _output(self, cmd: str, capture: bool | None) -> StreamedOutput | None:
+        capture = self._capture.get() if capture is None else capture
+        return None if capture else StreamedOutput(cmd, self.tail_limit, self.log)
+
     def pipe(self, cmd: str) -> Shell:
         self.cmd += f" | {cmd}"
         return self
@@ -70,35 +647,164 @@ class Shell(Runnable):
         return self
 
     def _get_process_owner_username(self) -> str:
-        owner = os.getuid()
-        pw_entry = pwd.getpwuid(owner)
-        return pw_entry.pw_name
+        return _process_owner()
+
+    def script(self) -> str:
+        return _script_home(self.cmd)
+
+    def run(self, user: str = None, cwd: str = None, sudo: bool = False, capture: bool = None) -> subprocess.CompletedProcess:
+        """
+        capture: keep the entire output in memory (default), otherwise print it live and keep only its last tail_limit bytes.
+        Defaults to streaming within Shell.streaming().
+        """
+        backend = Backend.current()
+        cmd = backend.expand(self.cmd)
+
+        user = user if user else backend.owner()
+
+        cwd = cwd if cwd else backend.cwd()
+
+        output = self._output(cmd, capture)
+        # streamed output is printed live, so is the command it belongs to
+        (print if output is None else print_live)(f"{AnsiColor.GREEN}{user}{AnsiColor.END}@{AnsiColor.LIGHT_CYAN}{cwd}{AnsiColor.END} {'sudo ' if sudo else ''}{cmd}")
+        r = backend.execute(cmd, cwd, user, sudo, output)
+        self._trace(r, output)
+        return r
+
+    @staticmethod
+    def _trace(r: subprocess.CompletedProcess, output: StreamedOutput | None) -> None:
+        if output is None:
+            Tracer.process(r)
+        else:
+            Tracer.process(r, stdout=output.sizes[1], stderr=output.sizes[2])
+
+    async def run_async(self, user: str = None, cwd: str = None, sudo: bool = False, capture: bool = None) -> subprocess.CompletedProcess:
+        backend = Backend.current()
+        cmd = backend.expand(self.cmd)
+        user = user if user else backend.owner()
+        cwd = cwd if cwd else backend.cwd()
+        output = self._output(cmd, capture)
+        (print if output is None else print_live)(f"{AnsiColor.GREEN}{user}{AnsiColor.END}@{AnsiColor.LIGHT_CYAN}{cwd}{AnsiColor.END} {'sudo ' if sudo else ''}{cmd}")
+        r = await backend.execute_async(cmd, cwd, user, sudo, output)
+        self._trace(r, output)
+        return r
+
+
+class FileSystemCheck(Runnable):
+    """
+    Runnable performing a simple file system operation in-process instead of spawning a shell.
+    Returns a subprocess.CompletedProcess like Shell.run, and falls back to the equivalent Shell when run as another user
+    or on a remote backend.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} '{self.path}'>"
+
+    @abstractmethod
+    def shell(self) -> Shell:
+        """
+        Returns the equivalent Shell command.
+        """
+        pass
+
+    @abstractmethod
+    def check(self, path: str) -> bool:
+        """
+        Performs the operation on the expanded path, returns true on success.
+        """
+        pass
 
     def run(self, user: str = None, cwd: str = None, sudo: bool = False) -> subprocess.CompletedProcess:
-        cmd = "sudo " + self.cmd if sudo else self.cmd
-        cmd = os.path.expandvars(cmd.replace('~', '$HOME'))
+        if sudo or not Backend.current().local or (user and user != _process_owner()):
+            return self.shell().run(user=user, cwd=cwd, sudo=sudo)
+        path = os.path.join(cwd if cwd else os.getcwd(), _expand(self.path))
+        try:
+            ok, stderr = self.check(path), b''
+        except OSError as e:
+            ok, stderr = False, str(e).encode()
+        return subprocess.CompletedProcess(self.shell().cmd, 0 if ok else 1, b'', stderr)
+
+    async def run_async(self, user: str = None, cwd: str = None, sudo: bool = False) -> subprocess.CompletedProcess:
+        if sudo or not Backend.current().local or (user and user != _process_owner()):
+            return await self.shell().run_async(user=user, cwd=cwd, sudo=sudo)
+        # a stat doesn't block long enough to be worth a thread
+        return self.run(user=user, cwd=cwd, sudo=sudo)
+
+    def script(self) -> str:
+        return self.shell().script()
+
+
+class FileExists(FileSystemCheck):
+    """
+    Same as Shell("test -f path").
+    """
+    def shell(self) -> Shell:
+        return Shell(f"test -f '{self.path}'")
 
-        user = user if user else self._get_process_owner_username()
+    def check(self, path: str) -> bool:
+        return os.path.isfile(path)
 
-        cwd = cwd if cwd else os.getcwd()
 
-        print(f"{AnsiColor.GREEN}{user}{AnsiColor.END}@{AnsiColor.LIGHT_CYAN}{cwd}{AnsiColor.END} {cmd}")
-        return subprocess.run(
-                cmd,
-                capture_output=True, 
-                cwd=cwd, 
-                user=user, 
-                shell=True,
-            )
+class DirExists(FileSystemCheck):
+    """
+    Same as Shell("test -d path").
+    """
+    def shell(self) -> Shell:
+        return Shell(f"test -d '{self.path}'")
 
+    def check(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+
+class SymlinkTo(FileSystemCheck):
+    """
+    Same as Shell("test -L path"), optionally also checks the target of the link.
+    """
+    def __init__(self, path: str, target: str = None):
+        """
+        path: path of the symbolic link
+        target: expected target of the link, any target if None
+        """
+        super().__init__(path)
+        self.target = target
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} '{self.path}' -> '{self.target}'>"
+
+    def shell(self) -> Shell:
+        if self.target is None:
+            return Shell(f"test -L '{self.path}'")
+        return Shell(f"test -L '{self.path}' && test \"$(readlink '{self.path}')\" = '{self.target}'")
+
+    def check(self, path: str) -> bool:
+        if not os.path.islink(path):
+            return False
+        return self.target is None or os.readlink(path) == _expand(self.target)
+
+
+class MakeDirs(FileSystemCheck):
+    """
+    Same as Shell("mkdir -p path").
+    """
+    def shell(self) -> Shell:
+        return Shell(f"mkdir -p '{self.path}'")
+
+    def check(self, path: str) -> bool:
+        os.makedirs(path, exist_ok=True)
+        return True
 
 
 class Command(State):
     """
     State that reaches his target State by running different Shell runnables.
+    In-process runnables like FileExists can be used instead of Shell scripts.
     """
+    __slots__ = ('_install', '_uninstall', '_detect')
+    cost = 5.0
 
-    def __init__(self, install: Shell, uninstall: Shell, detect: Shell):
+    def __init__(self, install: Runnable, uninstall: Runnable, detect: Runnable):
         """
         install: Shell script to install target
         uninstall: Shell script to uninstall target
@@ -109,21 +815,390 @@ class Command(State):
         self._detect = detect
 
     def install(self):
-        r = self._install.run()
+        with Shell.streaming():
+            r = self._install.run()
         assert r.returncode == 0, f"install failed: Shell exit code {r.returncode}\n{r.stderr.decode()}"
 
     def uninstall(self):
-        r = self._uninstall.run()
+        with Shell.streaming():
+            r = self._uninstall.run()
         assert r.returncode == 0, f"uninstall failed: Shell exit code {r.returncode}\n{r.stderr.decode()}"
 
     def detect(self):
         r = self._detect.run()
         return r.returncode == 0
 
+    def watch_paths(self) -> tuple[str, ...]:
+        # the paths a Shell script depends on are unknown
+        return (self._detect.path,) if isinstance(self._detect, FileSystemCheck) else ()
+
+    async def async_install(self):
+        with Shell.streaming():
+            r = await self._install.run_async()
+        assert r.returncode == 0, f"install failed: Shell exit code {r.returncode}\n{r.stderr.decode()}"
+
+    async def async_uninstall(self):
+        with Shell.streaming():
+            r = await self._uninstall.run_async()
+        assert r.returncode == 0, f"uninstall failed: Shell exit code {r.returncode}\n{r.stderr.decode()}"
+
+    async def async_detect(self):
+        r = await self._detect.run_async()
+        return r.returncode == 0
+
+    def script_detect(self, script: Script) -> str | None:
+        return self._detect.script()
+
+    def script_install(self, script: Script) -> str | None:
+        return self._install.script()
+
+    def script_uninstall(self, script: Script) -> str | None:
+        return self._uninstall.script()
+
+
+def _redetect(states: list[State]) -> None:
+    """
+    Forgets the detect results of states in the active Run, a failed batch may have installed or uninstalled some of them.
+    """
+    run = Run.current()
+    if run is not None:
+        run.invalidate(*states)
+
+
+def _mtimes(*paths: str) -> str | None:
+    """
+    Returns the modification times of paths as fingerprint, '-' for missing paths.
+    None on remote backends, whose files can't be checked in-process.
+    """
+    if not Backend.current().local:
+        return None
+    parts = []
+    for path in paths:
+        try:
+            parts.append(str(os.stat(_expand(path)).st_mtime_ns))
+        except OSError:
+            parts.append('-')
+    return ' '.join(parts)
+
+
+_LOCK_CONTENTION = re.compile(
+    r"Could not get lock"
+    r"|Unable to acquire the dpkg frontend lock"
+    r"|dpkg frontend lock was locked by another process"
+    r"|status database (area )?is locked"
+    r"|change \d+ in progress|has .* change in progress"
+)
+
+_PACKAGE_NOT_FOUND = re.compile(r"Unable to locate package|has no installation candidate")
+
+
+def _run_waiting(shell: Shell, sudo: bool = False, timeout: float = 300.0) -> subprocess.CompletedProcess:
+    """
+    Runs shell with streamed output and retries with exponential backoff as long as it fails because another process (unattended-upgrades, snapd, a second run) holds the package manager lock.
+    timeout: seconds to wait in total before the last failure is returned.
+    """
+    delay = 1.0
+    waited = 0.0
+    while True:
+        r = shell.run(sudo=sudo, capture=False)
+        if r.returncode == 0 or waited >= timeout or not _LOCK_CONTENTION.search(r.stderr.decode(errors='replace')):
+            return r
+        print(f"# waiting {delay:.0f}s for package manager lock")
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 30.0)
+
 
 # packet managers
 
+def _script_then(code: str, *after: str) -> str:
+    """
+    Returns shell code running code, then after, exiting with the exit code of code.
+    """
+    return '\n'.join([code, 'set -- $?', *after, 'return "$1"'])
+
+
+class Inventory(ABC):
+    """
+    Set of installed packages of a package manager, loaded on first use with a single listing command.
+    States answer detect from the inventory and keep it up to date in install and uninstall.
+    """
+    def __init__(self):
+        self._installed = None
+        self._loading = None
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _command(self) -> Shell:
+        """
+        Returns the listing command.
+        """
+        pass
+
+    @abstractmethod
+    def _parse(self, r: subprocess.CompletedProcess) -> set | None:
+        """
+        Returns the keys of all installed packages from the result of the listing command, None if the listing failed.
+        """
+        pass
+
+    def contains(self, key) -> bool:
+        with self._lock:
+            if self._installed is None:
+                installed = self._parse(self._command().run(capture=True))
+                if installed is None:
+                    return False
+                self._installed = installed
+            return key in self._installed
+
+    async def async_contains(self, key) -> bool:
+        """
+        Asynchronous version of contains, concurrent callers share a single listing command.
+        """
+        if self._installed is None:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._command().run_async(capture=True))
+            loading = self._loading
+            try:
+                installed = self._parse(await loading)
+            finally:
+                if self._loading is loading:
+                    self._loading = None
+            if installed is None:
+                return False
+            with self._lock:
+                if self._installed is None:
+                    self._installed = installed
+        with self._lock:
+            return self._installed is not None and key in self._installed
+
+    def add(self, key) -> None:
+        with self._lock:
+            if self._installed is not None:
+                self._installed.add(key)
+
+    def discard(self, key) -> None:
+        with self._lock:
+            if self._installed is not None:
+                self._installed.discard(key)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._installed = None
+
+    # shell code turning the output of the listing command into one key per line, for export_script
+    script_keys: str = None
+
+    @classmethod
+    def script_contains(cls, script: Script, key: str) -> str:
+        """
+        Returns shell code exiting with 0 if the inventory contains key, listed once per script.
+        """
+        listing = f"sg_listing=$({cls()._command().script()}) || return 1\nprintf '%s\\n' \"$sg_listing\" | {cls.script_keys}"
+        return script.contains(cls.__name__, listing, key)
+
+    @classmethod
+    def script_invalidate(cls, script: Script) -> str:
+        return script.forget(cls.__name__)
+
+    @classmethod
+    def current(cls) -> Inventory:
+        """
+        Returns the inventory of the active Run, or a fresh one outside of a Run.
+        """
+        run = Run.current()
+        return run.scoped(cls) if run is not None else cls()
+
+
+class DpkgIndex(Inventory):
+    """
+    Installed debian packages, shared by Apt and Dpkg.
+    Invalidated on every change, since apt also installs and removes dependencies.
+    """
+    script_keys = "awk '$NF == \"installed\" { print $1 }'"
+
+    def _command(self) -> Shell:
+        return Shell("dpkg-query -W -f='${Package} ${Status}\\n'")
+
+    def _parse(self, r: subprocess.CompletedProcess) -> set[str]:
+        assert r.returncode == 0, f"failed to query installed packages.\nstderr: {r.stderr.decode()}"
+        installed = set()
+        for line in r.stdout.decode().splitlines():
+            # e.g. 'zsh install ok installed' or 'vim deinstall ok config-files'
+            package, *status = line.split()
+            if status and status[-1] == 'installed':
+                installed.add(package)
+        return installed
+
+
+class AptLists:
+    """
+    Package lists of apt for a Run, refreshed with a single `apt update` shared by all Apt states.
+    The lists are refreshed when they are older than max_age, after AddAptRepository changed the sources
+    or when apt can't find a package, but never twice in a Run unless the sources changed in between.
+    """
+    # seconds until the package lists are considered outdated
+    max_age: float = 24 * 60 * 60
+
+    # apt update always touches partial/, the lists only change with the repositories
+    paths = ('/var/lib/apt/lists/partial', '/var/lib/apt/lists')
+
+    def __init__(self):
+        self.generation = 0
+        self._refreshed = False
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def age(self) -> float:
+        mtimes = []
+        if not Backend.current().local:
+            r = Shell(f"stat -c %Y {' '.join(self.paths)}").run(capture=True)
+            mtimes = [float(line) for line in r.stdout.decode().split()]
+            # the clocks of both machines may differ, the age is measured by the remote one
+            now = Shell("date +%s").run(capture=True).stdout.decode().strip()
+            return float(now) - max(mtimes) if mtimes and now else float('inf')
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return time.time() - max(mtimes) if mtimes else float('inf')
+
+    def sources_changed(self) -> None:
+        """
+        Marks the lists outdated, the next Apt state refreshes them.
+        """
+        with self._lock:
+            self._stale = True
+
+    def ensure_fresh(self) -> None:
+        """
+        Refreshes the lists if the sources changed or, once per Run, if they are older than max_age.
+        """
+        with self._lock:
+            if self._stale or (not self._refreshed and self.age() > self.max_age):
+                self._update()
+
+    def refresh(self, since: int) -> bool:
+        """
+        Refreshes the lists after a package wasn't found.
+        since: generation the failed command ran with.
+        Returns True if the lists changed since then, meaning the command is worth retrying.
+        """
+        with self._lock:
+            if self.generation != since:
+                return True
+            if self._refreshed and not self._stale:
+                return False
+            self._update()
+            return True
+
+    @classmethod
+    def script_sources_changed(cls) -> str:
+        return 'sg_apt_stale=1'
+
+    @classmethod
+    def script_install(cls, script: Script) -> str:
+        """
+        Defines and returns the shell function installing the packages passed to it, with the same refresh logic as Apt.
+        """
+        fresh = ['[ -z "${sg_apt_stale-}" ] && [ -n "${sg_apt_updated-}" ] && return 0']
+        if cls.max_age != float('inf'):
+            fresh += [
+                'if [ -z "${sg_apt_stale-}" ]; then',
+                f"    sg_mtime=$(stat -c %Y {' '.join(cls.paths)} 2>/dev/null | sort -n | tail -n 1)",
+                f"    [ $(( $(date +%s) - ${{sg_mtime:-0}} )) -gt {int(cls.max_age)} ] || return 0",
+                'fi',
+            ]
+        else:
+            fresh += ['[ -n "${sg_apt_stale-}" ] || return 0']
+        fresh += ['sg_sudo apt-get update -o DPkg::Lock::Timeout=300 || return 1', 'sg_apt_updated=1', 'sg_apt_stale=']
+        script.define('sg_apt_fresh', '\n'.join(fresh))
+        forget = DpkgIndex.script_invalidate(script)
+        return script.define('sg_apt_install', '\n'.join([
+            'sg_apt_fresh || return 1',
+            'if ! sg_sudo apt-get install -y -o DPkg::Lock::Timeout=300 "$@"; then',
+            f"    {forget}",
+            '    # try again with refreshed package lists, unless they are already refreshed',
+            '    [ -z "${sg_apt_updated-}" ] || [ -n "${sg_apt_stale-}" ] || return 1',
+            '    sg_apt_stale=1',
+            '    sg_apt_fresh && sg_sudo apt-get install -y -o DPkg::Lock::Timeout=300 "$@" || return 1',
+            'fi',
+            forget,
+        ]))
+
+    def _update(self) -> None:
+        r = _run_waiting(Shell("apt update -y"), sudo=True)
+        if r.returncode != 0:
+            raise Exception(f"failed to update package lists. \nstderr: {r.stderr.decode()}")
+        self._refreshed = True
+        self._stale = False
+        self.generation += 1
+
+    @classmethod
+    def current(cls) -> AptLists:
+        """
+        Returns the package lists of the active Run, or fresh ones outside of a Run.
+        """
+        run = Run.current()
+        return run.scoped(cls) if run is not None else cls()
+
+
+class FlatpakInventory(Inventory):
+    """
+    Installed flatpak applications as (application, installation) pairs, e.g. ('com.spotify.Client', 'user').
+    """
+    script_keys = "awk -F '\\t' 'NF >= 2 { print $1 \" \" $2 }'"
+
+    def _command(self) -> Shell:
+        return Shell("flatpak list --app --columns=application,installation")
+
+    def _parse(self, r: subprocess.CompletedProcess) -> set[tuple[str, str]] | None:
+        if r.returncode != 0:
+            return None
+        return {tuple(line.split('\t')[:2]) for line in r.stdout.decode().splitlines() if '\t' in line}
+
+
+class SnapInventory(Inventory):
+    """
+    Installed snap names.
+    """
+    script_keys = "awk 'NR > 1 && NF { print $1 }'"
+
+    def _command(self) -> Shell:
+        return Shell("snap list")
+
+    def _parse(self, r: subprocess.CompletedProcess) -> set[str] | None:
+        if r.returncode != 0:
+            return None
+        # skip the header 'Name  Version  Rev  Tracking  Publisher  Notes'
+        return {line.split()[0] for line in r.stdout.decode().splitlines()[1:] if line.strip()}
+
+
+class PipInventory(Inventory):
+    """
+    Installed distributions of the pip found in PATH, with normalized names.
+    """
+    @staticmethod
+    def normalize(name: str) -> str:
+        return re.sub(r'[-_.]+', '-', name).lower()
+
+    # one object per line, names normalized like normalize does
+    script_keys = "tr '{' '\\n' | sed -n 's/.*\"name\": *\"\\([^\"]*\\)\".*/\\1/p' | sed 's/[-_.][-_.]*/-/g' | tr 'A-Z' 'a-z'"
+
+    def _command(self) -> Shell:
+        return Shell("pip list --format=json")
+
+    def _parse(self, r: subprocess.CompletedProcess) -> set[str] | None:
+        if r.returncode != 0:
+            return None
+        return {self.normalize(d['name']) for d in json.loads(r.stdout.decode())}
+
+
 class Dpkg(State):
+    __slots__ = ('package', 'archive')
+    cost = 5.0
+
     def __init__(self, package: str, archive: str):
         """
         package: package name of the installed archive (for an archive 'dpkg --info *.db').
@@ -132,50 +1207,154 @@ class Dpkg(State):
         self.package = package
         self.archive = archive
 
+    def provides(self) -> tuple:
+        return (('apt', self.package),)
+
+    def resources(self) -> tuple[str, ...]:
+        return ('dpkg-lock',) + super().resources()
+
     def install(self):
-        assert os.path.isfile(self.archive), f"archive must be a file, got '{self.archive}'."
-        r = Shell(f"dpkg --install '{self.archive}'").run(sudo=True)
+        assert FileExists(self.archive).run().returncode == 0, f"archive must be a file, got '{self.archive}'."
+        r = _run_waiting(Shell(f"dpkg --install '{self.archive}'"), sudo=True)
+        DpkgIndex.current().invalidate()
         assert r.returncode == 0, f"failed to install '{self.archive}'. \nstderr: {r.stderr.decode()}"
 
     def uninstall(self):
-        r = Shell(f"dpkg --remove '{self.package}'").run(sudo=True)
+        r = _run_waiting(Shell(f"dpkg --remove '{self.package}'"), sudo=True)
+        DpkgIndex.current().invalidate()
         assert r.returncode == 0, f"failed to uninstall '{self.archive}'. \nstderr: {r.stderr.decode()}"
 
+    def fingerprint(self) -> str:
+        return _mtimes('/var/lib/dpkg/status')
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return ('/var/lib/dpkg/status',)
+
     def detect(self):
-        r = Shell(f"dpkg --status '{self.package}'").run()
-        return r.returncode == 0
+        return DpkgIndex.current().contains(self.package)
+
+    async def async_detect(self):
+        return await DpkgIndex.current().async_contains(self.package)
+
+    def script_detect(self, script: Script) -> str:
+        return DpkgIndex.script_contains(script, self.package)
+
+    def script_install(self, script: Script) -> str:
+        cmd = Shell(f"test -f '{self.archive}' && sg_sudo dpkg --install '{self.archive}'").script()
+        return _script_then(cmd, DpkgIndex.script_invalidate(script))
+
+    def script_uninstall(self, script: Script) -> str:
+        return _script_then(f"sg_sudo dpkg --remove '{self.package}'", DpkgIndex.script_invalidate(script))
 
 
 class Apt(State):
+    __slots__ = ('package',)
+    cost = 10.0
+
     def __init__(self, package: str):
         """
         package: apt package name
         """
         self.package = package
 
+    def provides(self) -> tuple:
+        return (('apt', self.package),)
+
+    def resources(self) -> tuple[str, ...]:
+        return ('dpkg-lock',) + super().resources()
+
     def install(self):
-        r = Shell(f"apt install -y '{self.package}'").run(sudo=True)
+        lists = AptLists.current()
+        lists.ensure_fresh()
+        generation = lists.generation
+        r = _run_waiting(Shell(f"apt install -y '{self.package}'"), sudo=True)
+        DpkgIndex.current().invalidate()
         if r.returncode == 0:
             return
-        # try again with `apt update`
-        assert Shell(f"sudo apt update -y").run(sudo=True).returncode == 0
-        r = Shell(f"apt install -y '{self.package}'").run(sudo=True)
+        # try again with refreshed package lists
+        if _PACKAGE_NOT_FOUND.search(r.stderr.decode(errors='replace')) and lists.refresh(generation):
+            r = _run_waiting(Shell(f"apt install -y '{self.package}'"), sudo=True)
+            DpkgIndex.current().invalidate()
+            if r.returncode == 0:
+                return
+        raise Exception(f"failed to install '{self.package}'. \nstderr: {r.stderr.decode()}")
+
+    def batch_key(self):
+        return 'apt'
+
+    @classmethod
+    def install_batch(cls, states: list[Apt]):
+        lists = AptLists.current()
+        lists.ensure_fresh()
+        generation = lists.generation
+        packages = ' '.join(f"'{s.package}'" for s in states)
+        r = _run_waiting(Shell(f"apt install -y {packages}"), sudo=True)
+        DpkgIndex.current().invalidate()
         if r.returncode == 0:
             return
-        raise Exception(f"failed to install '{self.package}'. \nstderr: {r.stderr.decode()}")
+        if _PACKAGE_NOT_FOUND.search(r.stderr.decode(errors='replace')) and lists.refresh(generation):
+            r = _run_waiting(Shell(f"apt install -y {packages}"), sudo=True)
+            DpkgIndex.current().invalidate()
+            if r.returncode == 0:
+                return
+        # fall back to installing package by package
+        _redetect(states)
+        for state in states:
+            state.ensure_installed()
 
     def uninstall(self):
-        r = Shell(f"apt remove '{self.package}'").run(sudo=True)
+        r = _run_waiting(Shell(f"apt remove -y '{self.package}'"), sudo=True)
+        DpkgIndex.current().invalidate()
         if r.returncode == 0:
             return
         raise Exception(f"failed to uninstall '{self.package}'. \nstderr: {r.stderr.decode()}")
 
+    @classmethod
+    def uninstall_batch(cls, states: list[Apt]):
+        packages = ' '.join(f"'{s.package}'" for s in states)
+        r = _run_waiting(Shell(f"apt remove -y {packages}"), sudo=True)
+        DpkgIndex.current().invalidate()
+        if r.returncode == 0:
+            return
+        # fall back to uninstalling package by package
+        _redetect(states)
+        for state in states:
+            state.ensure_uninstalled()
+
+    def fingerprint(self) -> str:
+        return _mtimes('/var/lib/dpkg/status')
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return ('/var/lib/dpkg/status',)
+
     def detect(self) -> bool:
-        r = Shell(f"dpkg --status '{self.package}'").run()
-        return r.returncode == 0
+        return DpkgIndex.current().contains(self.package)
+
+    async def async_detect(self) -> bool:
+        return await DpkgIndex.current().async_contains(self.package)
+
+    def script_detect(self, script: Script) -> str:
+        return DpkgIndex.script_contains(script, self.package)
+
+    def script_install(self, script: Script) -> str:
+        return f"{AptLists.script_install(script)} {self.script_argument()}"
+
+    def script_argument(self) -> str:
+        return f"'{self.package}'"
+
+    @classmethod
+    def script_install_batch(cls, states: list[Apt], script: Script) -> str:
+        return f"{AptLists.script_install(script)} \"$@\""
+
+    def script_uninstall(self, script: Script) -> str:
+        cmd = f"sg_sudo apt-get remove -y -o DPkg::Lock::Timeout=300 '{self.package}'"
+        return _script_then(cmd, DpkgIndex.script_invalidate(script))
 
 
 class Snap(State):
+    __slots__ = ('package', 'classic')
+    cost = 20.0
+
     def __init__(self, package: str, classic: bool = False):
         """
         package: snap package name
@@ -184,24 +1363,70 @@ class Snap(State):
         self.package = package
         self.classic = classic
 
+    def needs(self) -> tuple:
+        return (('apt', 'snapd'),)
+
+    def resources(self) -> tuple[str, ...]:
+        return ('snapd',) + super().resources()
+
     def install(self):
-        r = Shell(f"snap install {'--classic' if self.classic else ''} '{self.package}'").run(sudo=True)
+        r = _run_waiting(Shell(f"snap install {'--classic' if self.classic else ''} '{self.package}'"), sudo=True)
         if r.returncode == 0:
+            SnapInventory.current().add(self.package)
             return
         raise Exception(f"failed to install '{self.package}'. \nstderr: {r.stderr.decode()}")
 
     def uninstall(self):
-        r = Shell(f"snap remove '{self.package}'").run(sudo=True)
+        r = _run_waiting(Shell(f"snap remove '{self.package}'"), sudo=True)
         if r.returncode == 0:
+            SnapInventory.current().discard(self.package)
             return
         raise Exception(f"failed to uninstall '{self.package}'. \nstderr: {r.stderr.decode()}")
 
+    def batch_key(self):
+        # snap refuses to install several snaps with --classic at once
+        return None if self.classic else 'snap'
+
+    @classmethod
+    def uninstall_batch(cls, states: list[Snap]):
+        packages = ' '.join(f"'{s.package}'" for s in states)
+        r = _run_waiting(Shell(f"snap remove {packages}"), sudo=True)
+        if r.returncode == 0:
+            for state in states:
+                SnapInventory.current().discard(state.package)
+            return
+        SnapInventory.current().invalidate()
+        _redetect(states)
+        for state in states:
+            state.ensure_uninstalled()
+
+    def fingerprint(self) -> str:
+        return _mtimes('/var/lib/snapd/snaps')
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return ('/var/lib/snapd/snaps',)
+
     def detect(self) -> bool:
-        r = Shell(f"snap list '{self.package}'").run()
-        return r.returncode == 0
+        return SnapInventory.current().contains(self.package)
+
+    async def async_detect(self) -> bool:
+        return await SnapInventory.current().async_contains(self.package)
+
+    def script_detect(self, script: Script) -> str:
+        return SnapInventory.script_contains(script, self.package)
+
+    def script_install(self, script: Script) -> str:
+        cmd = f"sg_sudo snap install {'--classic ' if self.classic else ''}'{self.package}'"
+        return _script_then(cmd, SnapInventory.script_invalidate(script))
+
+    def script_uninstall(self, script: Script) -> str:
+        return _script_then(f"sg_sudo snap remove '{self.package}'", SnapInventory.script_invalidate(script))
         
 
 class Flatpak(State):
+    __slots__ = ('package', 'remote', 'system')
+    cost = 30.0
+
     def __init__(self, package: str, system: bool = False, remote='flathub'):
         """
         package: name of flatpak package
@@ -211,55 +1436,167 @@ class Flatpak(State):
         self.remote = remote
         self.system = '--system' if system else '--user'
 
+    def _key(self) -> tuple[str, str]:
+        return (self.package, self.system.removeprefix('--'))
+
+    def needs(self) -> tuple:
+        return (('apt', 'flatpak'), ('flatpak-remote', self.remote, self.system.removeprefix('--')))
+
+    def resources(self) -> tuple[str, ...]:
+        return (f"flatpak-{self.system.removeprefix('--')}",) + super().resources()
+
     def install(self):
-        r = Shell(f"flatpak install -y {self.system} {self.remote} '{self.package}'").run()
+        r = Shell(f"flatpak install -y {self.system} {self.remote} '{self.package}'").run(capture=False)
         if r.returncode == 0:
+            FlatpakInventory.current().add(self._key())
             return
         raise Exception(f"failed to install '{self.package}'. \nstderr: {r.stderr.decode()}")
 
     def uninstall(self):
-        r = Shell(f"flatpak uninstall -y '{self.package}'").run()
+        r = Shell(f"flatpak uninstall -y '{self.package}'").run(capture=False)
         if r.returncode == 0:
+            FlatpakInventory.current().discard(self._key())
             return
         raise Exception(f"failed to uninstall '{self.package}'. \nstderr: {r.stderr.decode()}")
 
+    def batch_key(self):
+        return (self.remote, self.system)
+
+    @classmethod
+    def install_batch(cls, states: list[Flatpak]):
+        # one transaction resolves and downloads shared runtimes once
+        packages = ' '.join(f"'{s.package}'" for s in states)
+        r = Shell(f"flatpak install -y {states[0].system} {states[0].remote} {packages}").run(capture=False)
+        if r.returncode == 0:
+            for state in states:
+                FlatpakInventory.current().add(state._key())
+            return
+        # fall back to installing app by app, so the failing app is reported
+        FlatpakInventory.current().invalidate()
+        _redetect(states)
+        for state in states:
+            state.ensure_installed()
+
+    @classmethod
+    def uninstall_batch(cls, states: list[Flatpak]):
+        packages = ' '.join(f"'{s.package}'" for s in states)
+        r = Shell(f"flatpak uninstall -y {states[0].system} {packages}").run(capture=False)
+        if r.returncode == 0:
+            for state in states:
+                FlatpakInventory.current().discard(state._key())
+            return
+        FlatpakInventory.current().invalidate()
+        _redetect(states)
+        for state in states:
+            state.ensure_uninstalled()
+
+    def fingerprint(self) -> str:
+        return _mtimes(*self.watch_paths())
+
+    def watch_paths(self) -> tuple[str, ...]:
+        if self.system == '--system':
+            return ('/var/lib/flatpak/app',)
+        return ('~/.local/share/flatpak/app',)
+
     def detect(self) -> bool:
-        r = Shell(f"flatpak info {self.system} '{self.package}'").run()
-        return r.returncode == 0
+        return FlatpakInventory.current().contains(self._key())
+
+    async def async_detect(self) -> bool:
+        return await FlatpakInventory.current().async_contains(self._key())
+
+    def script_detect(self, script: Script) -> str:
+        return FlatpakInventory.script_contains(script, ' '.join(self._key()))
+
+    def script_install(self, script: Script) -> str:
+        cmd = f"flatpak install -y {self.system} {self.remote} '{self.package}'"
+        return _script_then(cmd, FlatpakInventory.script_invalidate(script))
+
+    def script_argument(self) -> str:
+        return f"'{self.package}'"
+
+    @classmethod
+    def script_install_batch(cls, states: list[Flatpak], script: Script) -> str:
+        return f"flatpak install -y {states[0].system} {states[0].remote} \"$@\"\n{FlatpakInventory.script_invalidate(script)}"
+
+    def script_uninstall(self, script: Script) -> str:
+        cmd = f"flatpak uninstall -y {self.system} '{self.package}'"
+        return _script_then(cmd, FlatpakInventory.script_invalidate(script))
 
 
 class AddAptRepository(State):
+    __slots__ = ('ppa',)
+    cost = 10.0
+
     def __init__(self, ppa: str):
         """
         ppa: url to apt repository
         """
         self.ppa = ppa
 
+    def needs(self) -> tuple:
+        return (('apt', 'software-properties-common'),)
+
+    def resources(self) -> tuple[str, ...]:
+        return ('dpkg-lock',) + super().resources()
+
     def install(self):
-        # add ppa
-        r = Shell(f"add-apt-repository -y '{self.ppa}'").run(sudo=True)
+        # add ppa, the package lists are refreshed once by the next Apt state
+        r = _run_waiting(Shell(f"add-apt-repository -y --no-update '{self.ppa}'"), sudo=True)
+        AptLists.current().sources_changed()
         if r.returncode != 0:
             raise Exception(f"failed to add repository '{self.ppa}'. \nstderr: {r.stderr.decode()}")
 
     def uninstall(self):
-        r = Shell(f"add-apt-repository --remove -y '{self.ppa}'").run(sudo=True)
+        r = _run_waiting(Shell(f"add-apt-repository --remove -y --no-update '{self.ppa}'"), sudo=True)
+        AptLists.current().sources_changed()
         if r.returncode == 0:
             return
         raise Exception(f"failed to remove repository '{self.ppa}'. \nstderr: {r.stderr.decode()}")
 
+    def fingerprint(self) -> str:
+        return _mtimes(*self.watch_paths())
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return ('/etc/apt/sources.list', '/etc/apt/sources.list.d')
+
     def detect(self) -> bool:
-        r = Shell(f"add-apt-repository --list").pipe(f"grep '{self.ppa}'").run()
+        r = Shell("add-apt-repository --list").pipe(f"grep '{self.ppa}'").run()
         output = r.stdout.decode()
         num_lines = output.count('\n')
         return num_lines > 0
 
+    async def async_detect(self) -> bool:
+        r = await Shell("add-apt-repository --list").pipe(f"grep '{self.ppa}'").run_async()
+        return r.stdout.decode().count('\n') > 0
+
+    def script_detect(self, script: Script) -> str:
+        return f"add-apt-repository --list | grep -q '{self.ppa}'"
+
+    def script_install(self, script: Script) -> str:
+        return _script_then(f"sg_sudo add-apt-repository -y --no-update '{self.ppa}'", AptLists.script_sources_changed())
+
+    def script_uninstall(self, script: Script) -> str:
+        return _script_then(f"sg_sudo add-apt-repository --remove -y --no-update '{self.ppa}'", AptLists.script_sources_changed())
+
 
 class AddFlatpakRemote(State):
+    __slots__ = ('name', 'url', 'system')
+    cost = 2.0
+
     def __init__(self, name: str, url: str, system: bool = False):
         self.name = name
         self.url = url
         self.system = 'system' if system else 'user'
 
+    def provides(self) -> tuple:
+        return (('flatpak-remote', self.name, self.system),)
+
+    def needs(self) -> tuple:
+        return (('apt', 'flatpak'),)
+
+    def resources(self) -> tuple[str, ...]:
+        return (f"flatpak-{self.system}",) + super().resources()
+
     def install(self):
         r = None
         match self.system:
@@ -282,60 +1619,805 @@ class AddFlatpakRemote(State):
         return
 
 
+    def fingerprint(self) -> str:
+        return _mtimes(*self.watch_paths())
+
+    def watch_paths(self) -> tuple[str, ...]:
+        if self.system == 'system':
+            return ('/var/lib/flatpak/repo/config',)
+        return ('~/.local/share/flatpak/repo/config',)
+
     def detect(self) -> bool:
         r = Shell("flatpak remotes --columns=name,options").pipe(f"grep \"{self.name}.*{self.system}\"").run()
         output = r.stdout.decode()
         num_lines = output.count('\n')
         return num_lines > 0
 
+    async def async_detect(self) -> bool:
+        r = await Shell("flatpak remotes --columns=name,options").pipe(f"grep \"{self.name}.*{self.system}\"").run_async()
+        return r.stdout.decode().count('\n') > 0
+
+    def script_detect(self, script: Script) -> str:
+        return f"flatpak remotes --columns=name,options | grep -q \"{self.name}.*{self.system}\""
+
+    def script_install(self, script: Script) -> str:
+        if self.system == 'system':
+            return f"sg_sudo flatpak remote-add --system '{self.name}' '{self.url}'"
+        return f"flatpak remote-add --user '{self.name}' '{self.url}'"
+
+    def script_uninstall(self, script: Script) -> str:
+        return f"sg_sudo flatpak remote-delete '{self.name}'"
+
 
 class Pip(State):
+    __slots__ = ('name', 'flags')
+    cost = 5.0
+
     def __init__(self, name: str, break_system_packages: bool = False):
         self.name = name
         self.flags = '--break-system-packages' if break_system_packages else ''
 
+    def needs(self) -> tuple:
+        return (('apt', 'python3-pip'),)
+
+    def resources(self) -> tuple[str, ...]:
+        return ('pip',) + super().resources()
+
     def install(self):
-        r = Shell(f"pip install {self.flags} '{self.name}'").run()
+        r = Shell(f"pip install {self.flags} '{self.name}'").run(capture=False)
         if r.returncode != 0:
             raise Exception(f"failed to install repository '{self.name}'. \nstderr: {r.stderr.decode()}")
+        PipInventory.current().add(PipInventory.normalize(self.name))
         return
 
 
     def uninstall(self):
-        r = Shell(f"pip uninstall '{self.name}' -y").run()
+        r = Shell(f"pip uninstall '{self.name}' -y").run(capture=False)
         if r.returncode != 0:
             raise Exception(f"failed to uninstall package '{self.name}'. \nstderr: {r.stderr.decode()}")
+        PipInventory.current().discard(PipInventory.normalize(self.name))
         return
 
+    def batch_key(self):
+        return self.flags
+
+    @classmethod
+    def install_batch(cls, states: list[Pip]):
+        # one resolver run for all packages
+        names = ' '.join(f"'{s.name}'" for s in states)
+        r = Shell(f"pip install {states[0].flags} {names}").run(capture=False)
+        if r.returncode == 0:
+            for state in states:
+                PipInventory.current().add(PipInventory.normalize(state.name))
+            return
+        # fall back to installing package by package, so the failing package is reported
+        PipInventory.current().invalidate()
+        _redetect(states)
+        for state in states:
+            state.ensure_installed()
+
+    @classmethod
+    def uninstall_batch(cls, states: list[Pip]):
+        names = ' '.join(f"'{s.name}'" for s in states)
+        r = Shell(f"pip uninstall -y {names}").run(capture=False)
+        if r.returncode == 0:
+            for state in states:
+                PipInventory.current().discard(PipInventory.normalize(state.name))
+            return
+        PipInventory.current().invalidate()
+        _redetect(states)
+        for state in states:
+            state.ensure_uninstalled()
+
+
+    def watch_paths(self) -> tuple[str, ...]:
+        # site-packages of this interpreter, usually also the one of the pip in PATH
+        return (sysconfig.get_path('purelib'), site.getusersitepackages())
 
     def detect(self) -> bool:
-        r = Shell(f"pip show '{self.name}'").run()
-        output = r.stdout.decode()
-        num_lines = output.count('\n')
-        return num_lines > 0
+        return PipInventory.current().contains(PipInventory.normalize(self.name))
+
+    async def async_detect(self) -> bool:
+        return await PipInventory.current().async_contains(PipInventory.normalize(self.name))
+
+    def script_detect(self, script: Script) -> str:
+        return PipInventory.script_contains(script, PipInventory.normalize(self.name))
+
+    def script_install(self, script: Script) -> str:
+        return _script_then(f"pip install {self.flags} '{self.name}'", PipInventory.script_invalidate(script))
+
+    def script_argument(self) -> str:
+        return f"'{self.name}'"
+
+    @classmethod
+    def script_install_batch(cls, states: list[Pip], script: Script) -> str:
+        return f"pip install {states[0].flags} \"$@\"\n{PipInventory.script_invalidate(script)}"
+
+    def script_uninstall(self, script: Script) -> str:
+        return _script_then(f"pip uninstall -y '{self.name}'", PipInventory.script_invalidate(script))
+
+
+class GitRefs:
+    """
+    Commits of remote git refs for a Run, each resolved once with git ls-remote.
+    """
+    def __init__(self):
+        self._commits = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_commit(ref: str) -> bool:
+        return re.fullmatch(r'[0-9a-f]{40}', ref) is not None
+
+    @staticmethod
+    def candidates(ref: str) -> list[str]:
+        """
+        Returns the remote ref names ref may stand for, in the order git resolves them, peeled tags first.
+        """
+        names = [ref, f"refs/{ref}", f"refs/tags/{ref}", f"refs/heads/{ref}"]
+        return [n for name in names for n in (name + '^{}', name)]
+
+    def resolve(self, url: str, ref: str) -> str | None:
+        """
+        Returns the commit ref points to in the repository at url, or None if it can't be resolved.
+        """
+        if self.is_commit(ref):
+            return ref
+        key = (url, ref)
+        with self._lock:
+            if key in self._commits:
+                return self._commits[key]
+        r = Shell(f"git ls-remote '{url}' '{ref}' '{ref}^{{}}'").run(capture=True)
+        commit = None
+        if r.returncode == 0:
+            refs = {}
+            for line in r.stdout.decode().splitlines():
+                sha, _, name = line.partition('\t')
+                refs.setdefault(name, sha)
+            commit = next((refs[name] for name in self.candidates(ref) if name in refs), None)
+        with self._lock:
+            self._commits[key] = commit
+        return commit
+
+    @classmethod
+    def script_resolve(cls, script: Script, url: str, ref: str) -> str:
+        """
+        Returns shell code printing the commit ref points to, with the same resolution as resolve.
+        """
+        if cls.is_commit(ref):
+            return f"echo {ref}"
+        name = script.define('sg_git_ref', '\n'.join([
+            'sg_refs=$(git ls-remote "$1" "$2" "$2^{}") || return 1',
+            'for sg_name in "$2^{}" "$2" "refs/$2^{}" "refs/$2" "refs/tags/$2^{}" "refs/tags/$2" "refs/heads/$2^{}" "refs/heads/$2"; do',
+            '    sg_sha=$(printf \'%s\\n\' "$sg_refs" | awk -v n="$sg_name" \'$2 == n { print $1; exit }\')',
+            '    [ -z "$sg_sha" ] || { echo "$sg_sha"; return 0; }',
+            'done',
+            'return 1',
+        ]))
+        return f"{name} '{url}' '{ref}'"
+
+    @classmethod
+    def current(cls) -> GitRefs:
+        """
+        Returns the refs of the active Run, or fresh ones outside of a Run.
+        """
+        run = Run.current()
+        return run.scoped(cls) if run is not None else cls()
 
 
 class GitClone(State):
-    def __init__(self, url: str, path: str):
+    """
+    State for a git checkout at path, of the default branch or, if given, of ref.
+    A checkout pinned to a branch or tag follows it: once the ref moved, the checkout is updated with a shallow fetch.
+    With a mirror directory the clones share the objects of a bare mirror of url kept in it,
+    so further clones of the same repository, e.g. for other users, only fetch what the mirror is missing.
+    """
+    __slots__ = ('url', 'path', 'ref', 'mirror')
+    cost = 5.0
+
+    def __init__(self, url: str, path: str, ref: str = None, mirror: str = None):
         """
         url: git repository url
         path: target path for repository
+        ref: branch, tag or full commit hash to check out, the default branch of a fresh clone if None
+        mirror: directory of the shared bare mirrors, e.g. '~/.cache/systemgoverner/git', not used if None
         """
         self.url = url
         self.path = path
+        self.ref = ref
+        self.mirror = mirror
+
+    def needs(self) -> tuple:
+        return (('apt', 'git'),)
+
+    def _mirror_path(self) -> str:
+        return os.path.join(self.mirror, hashlib.sha256(self.url.encode()).hexdigest()[:16] + '.git')
+
+    def _install_shell(self) -> Shell:
+        steps = []
+        if self.mirror is not None:
+            mirror = self._mirror_path()
+            # the lock keeps concurrent clones of the same url from updating the mirror at once
+            steps.append(
+                f"mkdir -p '{self.mirror}' && yes | flock '{mirror}.lock' sh -c "
+                f"'if [ -d \"$1\" ]; then git -C \"$1\" fetch -q --prune; else git clone -q --mirror \"$2\" \"$1\"; fi' "
+                f"sg '{mirror}' '{self.url}'"
+            )
+        if self.ref is None:
+            reference = f"--reference '{mirror}'" if self.mirror is not None else '--depth 1'
+            steps.append(f"mkdir -p '{self.path}' && yes | git clone {reference} '{self.url}' '{self.path}'")
+            return Shell(' && '.join(steps))
+        git = f"git -C '{self.path}'"
+        init = f"mkdir -p '{self.path}' && {git} init -q && {git} remote add origin '{self.url}'"
+        if self.mirror is not None:
+            init += f" && echo '{mirror}/objects' > '{os.path.join(self.path, '.git', 'objects', 'info', 'alternates')}'"
+        steps.append(f"{{ [ -d '{os.path.join(self.path, '.git')}' ] || {{ {init}; }}; }}")
+        # objects of the mirror are already shared, a fetch from it copies nothing
+        fetch = f"{git} fetch -q '{mirror}' '{self.ref}'" if self.mirror is not None else f"yes | {git} fetch -q --depth 1 origin '{self.ref}'"
+        steps.append(f"{fetch} && {git} checkout -q --detach FETCH_HEAD")
+        return Shell(' && '.join(steps))
 
     def install(self):
-        assert Shell(f"mkdir -p {self.path}").run().returncode == 0
-        r = Shell(f"yes | git clone --depth 1 '{self.url}' '{self.path}'").run()
+        r = self._install_shell().run(capture=False)
         assert r.returncode == 0, f"failed to clone repository '{self.url}' to '{self.path}'.\n{r.stderr.decode()}"
 
     def uninstall(self):
+        # the mirror is shared by other clones and kept
         r = Shell(f"rm -rf '{self.path}'").run()
         assert r.returncode == 0, f"failed to remove repository at '{self.path}'.\n{r.stderr.decode()}"
 
+    def fingerprint(self) -> str | None:
+        # a branch or tag may move on the remote without any local change
+        if self.ref is not None and not GitRefs.is_commit(self.ref):
+            return None
+        return _mtimes(*self.watch_paths())
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return (self.path, os.path.join(self.path, '.git', 'HEAD'))
+
     def detect(self) -> bool:
         git_dir = os.path.join(self.path, '.git')
-        r = Shell(f"test -d '{git_dir}'").run()
-        return r.returncode == 0
+        if self.ref is None:
+            return DirExists(git_dir).run().returncode == 0
+        r = Shell(f"git -C '{self.path}' rev-parse -q --verify HEAD").run(capture=True)
+        if r.returncode != 0:
+            return False
+        commit = GitRefs.current().resolve(self.url, self.ref)
+        return commit is not None and r.stdout.decode().strip() == commit
+
+    async def async_detect(self) -> bool:
+        if self.ref is not None:
+            return await asyncio.to_thread(self.detect)
+        git_dir = os.path.join(self.path, '.git')
+        return (await DirExists(git_dir).run_async()).returncode == 0
+
+    def script_detect(self, script: Script) -> str:
+        if self.ref is None:
+            return DirExists(os.path.join(self.path, '.git')).script()
+        commit = GitRefs.script_resolve(script, self.url, self.ref)
+        return Shell(f"test \"$(git -C '{self.path}' rev-parse -q --verify HEAD)\" = \"$({commit})\"").script()
+
+    def script_install(self, script: Script) -> str:
+        return self._install_shell().script()
+
+    def script_uninstall(self, script: Script) -> str:
+        return Shell(f"rm -rf '{self.path}'").script()
 
 
+# downloads
+
+class ConnectionPool:
+    """
+    Thread safe pool of keep-alive HTTP(S) connections, one list of idle connections per scheme and host.
+    Consecutive requests to the same host reuse the connection and its TLS session.
+    """
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, scheme: str, netloc: str):
+        """
+        Yields an idle or new connection, which is returned to the pool if no exception occurred.
+        """
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            factory = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = factory(netloc, timeout=self.timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, url: str, headers: dict, consume) -> tuple[int, str | None]:
+        """
+        Sends a GET request and passes the response to consume, unless it is a redirect.
+        Returns the status code and the redirect location, if any.
+        A failed request isn't retried, consume may have processed part of the response already,
+        so only the caller knows how to continue.
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self.connection(parts.scheme, parts.netloc) as conn:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            if 300 <= response.status < 400:
+                response.read()
+                return response.status, urljoin(url, response.getheader('Location'))
+            consume(response)
+            # read the rest of the body, required for reusing the connection
+            response.read()
+            return response.status, None
+
+
+_connections = ConnectionPool()
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Download(State):
+    """
+    State for a file downloaded over HTTP(S) to dest.
+    Downloaded files are kept in a content addressed cache directory, so reinstalling doesn't download them again.
+    Interrupted downloads are resumed with Range requests.
+    """
+    __slots__ = ('url', 'dest', 'sha256', 'mode', 'cache')
+    cost = 10.0
+    # attempts resuming an interrupted download before giving up
+    retries: int = 3
+
+    def __init__(self, url: str, dest: str, sha256: str = None, mode: int = None, cache: str = '~/.cache/systemgoverner/downloads'):
+        """
+        url: http or https url of the file
+        dest: target path, must be writable by the current user
+        sha256: expected hex digest of the file, detect only checks that dest exists if None
+        mode: file permissions of dest, e.g. 0o755
+        cache: directory of the download cache
+        """
+        self.url = url
+        self.dest = dest
+        self.sha256 = sha256.lower() if sha256 else None
+        self.mode = mode
+        self.cache = cache
+
+    def _cache_path(self, *parts: str) -> str:
+        return os.path.join(_expand(self.cache), *parts)
+
+    def _url_key(self) -> str:
+        return hashlib.sha256(self.url.encode()).hexdigest()
+
+    def _cached_blob(self) -> str | None:
+        """
+        Returns the cached file for url, None if not cached or if its content doesn't match its digest.
+        """
+        digest = self.sha256
+        if digest is None:
+            try:
+                with open(self._cache_path('urls', self._url_key())) as f:
+                    digest = f.read().strip()
+            except OSError:
+                return None
+        blob = self._cache_path('blobs', digest)
+        if not os.path.isfile(blob):
+            return None
+        # a blob damaged on disk is downloaded again
+        if _sha256(blob) != digest:
+            os.remove(blob)
+            return None
+        return blob
+
+    def _fetch(self) -> str:
+        """
+        Downloads url into the cache and returns the path of the cached file.
+        Downloads of the same url, in this or another process, wait for each other instead of sharing the partial file.
+        """
+        partial = self._cache_path('partial', self._url_key())
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(f"{partial}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # the download waited for may have cached the file meanwhile
+            return self._cached_blob() or self._download(partial)
+
+    def _download(self, partial: str) -> str:
+        url = self.url
+        redirects = failures = 0
+        while True:
+            # built from the partial file again on every attempt, it grows by what an interrupted attempt received
+            offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+            headers = {'User-Agent': 'systemgoverner', 'Range': f"bytes={offset}-"}
+
+            def consume(response):
+                if response.status not in (200, 206):
+                    return
+                # a server ignoring the Range header sends the whole file
+                with open(partial, 'ab' if response.status == 206 else 'wb') as f:
+                    # small chunks, what was received of a chunk is lost when the connection breaks
+                    for chunk in iter(lambda: response.read(1 << 16), b''):
+                        f.write(chunk)
+                # http.client ends the body quietly when the connection is closed before Content-Length was read
+                if response.length:
+                    raise http.client.IncompleteRead(b'', response.length)
+
+            try:
+                status, location = _connections.request(url, headers, consume)
+            except (http.client.HTTPException, ConnectionError, TimeoutError) as e:
+                # e.g. a reused connection closed by the server or a connection reset in the middle of the body
+                failures += 1
+                if failures > self.retries:
+                    raise Exception(f"failed to download '{self.url}': {e!r}")
+                continue
+            if location is not None:
+                redirects += 1
+                if redirects > 10:
+                    raise Exception(f"failed to download '{self.url}': too many redirects")
+                url = location
+                continue
+            # 416: the partial file is already complete
+            if status not in (200, 206, 416):
+                raise Exception(f"failed to download '{self.url}': HTTP status {status}")
+            break
+
+        digest = _sha256(partial)
+        if self.sha256 is not None and digest != self.sha256:
+            os.remove(partial)
+            raise Exception(f"failed to download '{self.url}': expected sha256 {self.sha256}, got {digest}")
+        blob = self._cache_path('blobs', digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(partial, blob)
+        os.makedirs(self._cache_path('urls'), exist_ok=True)
+        with open(self._cache_path('urls', self._url_key()), 'w') as f:
+            f.write(digest)
+        return blob
+
+    def _install_shell(self) -> Shell:
+        """
+        Returns the Shell downloading the file with curl, without the local download cache.
+        """
+        tmp = f"{self.dest}.tmp"
+        script = f"mkdir -p \"$(dirname '{self.dest}')\" && curl -fsSL --retry 3 -o '{tmp}' '{self.url}'"
+        if self.sha256 is not None:
+            script += f" && echo '{self.sha256}  {tmp}' | sha256sum -c --status"
+        if self.mode is not None:
+            script += f" && chmod {self.mode:o} '{tmp}'"
+        return Shell(f"{script} && mv '{tmp}' '{self.dest}' || {{ rm -f '{tmp}'; false; }}")
+
+    def _detect_shell(self) -> Shell:
+        check = f"test -f '{self.dest}'"
+        if self.sha256 is not None:
+            check += f" && echo '{self.sha256}  {self.dest}' | sha256sum -c --status"
+        return Shell(check)
+
+    def _remote_install(self):
+        # the remote machine downloads the file itself
+        r = self._install_shell().run(capture=False)
+        if r.returncode != 0:
+            raise Exception(f"failed to download '{self.url}'. \nstderr: {r.stderr.decode()}")
+
+    def install(self):
+        if not Backend.current().local:
+            return self._remote_install()
+        print(f"{AnsiColor.BLUE}download{AnsiColor.END} {self.url} -> {self.dest}")
+        blob = self._cached_blob() or self._fetch()
+        dest = _expand(self.dest)
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        shutil.copyfile(blob, tmp)
+        if self.mode is not None:
+            os.chmod(tmp, self.mode)
+        os.replace(tmp, dest)
+
+    def uninstall(self):
+        if not Backend.current().local:
+            r = Shell(f"rm '{self.dest}'").run()
+            assert r.returncode == 0, f"failed to remove '{self.dest}'. \nstderr: {r.stderr.decode()}"
+            return
+        os.remove(_expand(self.dest))
+
+    def fingerprint(self) -> str | None:
+        return _mtimes(self.dest) if self.sha256 is not None else None
+
+    def watch_paths(self) -> tuple[str, ...]:
+        return (self.dest,)
+
+    def detect(self) -> bool:
+        if not Backend.current().local:
+            return self._detect_shell().run().returncode == 0
+        dest = _expand(self.dest)
+        if not os.path.isfile(dest):
+            return False
+        return self.sha256 is None or _sha256(dest) == self.sha256
+
+    def script_detect(self, script: Script) -> str:
+        return self._detect_shell().script()
+
+    def script_install(self, script: Script) -> str:
+        return self._install_shell().script()
+
+    def script_uninstall(self, script: Script) -> str:
+        return Shell(f"rm '{self.dest}'").script()
+
+
+class HostResult:
+    """
+    Outcome of converging one host of a Fleet.
+    """
+    def __init__(self, host: str, error: Exception | None, seconds: float, output: str, run: Run | None):
+        self.host = host
+        self.error = error
+        self.seconds = seconds
+        self.output = output
+        self.detects = run.detects if run is not None else 0
+        self.avoided = run.avoided if run is not None else 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return f"<HostResult {self.host} {'ok' if self.ok else 'failed'} {self.seconds:.1f}s>"
+
+
+class Fleet:
+    """
+    Converges one State tree on many hosts concurrently, each host with its own Backend and Run.
+    All hosts share one event loop, on which composite States like Chain and Graph and all detects run as tasks.
+    Installs and uninstalls of States without a native asynchronous version, e.g. Apt, take a thread of one shared,
+    bounded thread pool only while they run, so hundreds of hosts don't need hundreds of threads.
+    """
+    def __init__(self, backends: dict[str, Backend], limit: int = 16, threads: int = 32, verbose: bool = False):
+        """
+        backends: backend per host name, e.g. {'ws1': SshBackend('ws1'), 'test': DockerBackend('test')}
+        limit: maximal number of hosts converged at once
+        threads: size of the thread pool running blocking State methods of ensure_installed and ensure_uninstalled
+        verbose: print the output of every host, otherwise only the output of failed hosts
+        """
+        self.backends = backends
+        self.limit = limit
+        self.threads = threads
+        self.verbose = verbose
+
+    async def _host(self, name: str, backend: Backend, fn, limit: asyncio.Semaphore) -> HostResult:
+        async with limit:
+            start = time.monotonic()
+            run, error = None, None
+            with captured_output() as output:
+                try:
+                    with backend:
+                        # fail early on unreachable hosts, and keep the event loop free while connecting
+                        await asyncio.to_thread(backend.owner)
+                        with Run() as run:
+                            await fn()
+                except Exception as e:
+                    error = e
+                    print(f"{AnsiColor.RED}{type(e).__name__}: {e}{AnsiColor.END}")
+            result = HostResult(name, error, time.monotonic() - start, output.getvalue(), run)
+        status = f"{AnsiColor.GREEN}ok{AnsiColor.END}" if result.ok else f"{AnsiColor.RED}failed{AnsiColor.END}"
+        print(f"# {name}: {status} after {result.seconds:.1f}s")
+        if self.verbose or not result.ok:
+            print(result.output, end='')
+        return result
+
+    async def _each(self, fn) -> list[HostResult]:
+        limit = asyncio.Semaphore(self.limit)
+        return list(await asyncio.gather(*(self._host(name, backend, fn(), limit) for name, backend in self.backends.items())))
+
+    async def async_ensure_installed(self, state: State) -> list[HostResult]:
+        return await self._each(lambda: state.async_ensure_installed)
+
+    async def async_ensure_uninstalled(self, state: State) -> list[HostResult]:
+        return await self._each(lambda: state.async_ensure_uninstalled)
+
+    def _run(self, coroutine) -> list[HostResult]:
+        async def main():
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.threads))
+            return await coroutine
+        return asyncio.run(main())
+
+    def ensure_installed(self, state: State) -> list[HostResult]:
+        """
+        Installs state on all hosts and returns the result of each host.
+        """
+        return self._run(self.async_ensure_installed(state))
+
+    def ensure_uninstalled(self, state: State) -> list[HostResult]:
+        """
+        Uninstalls state on all hosts and returns the result of each host.
+        """
+        return self._run(self.async_ensure_uninstalled(state))
+
+    @staticmethod
+    def report(results: list[HostResult]) -> str:
+        """
+        Returns a summary of the results, slowest hosts first.
+        """
+        failed = [r for r in results if not r.ok]
+        lines = [f"# {len(results) - len(failed)} of {len(results)} hosts converged"]
+        for r in sorted(results, key=lambda r: r.seconds, reverse=True):
+            status = 'ok' if r.ok else f"failed: {type(r.error).__name__}: {r.error}"
+            lines.append(f"#   {r.host:<24} {r.seconds:8.1f}s  {r.detects:>5} detects  {status}")
+        return '\n'.join(lines)
+
+
+# drift watching
+
+class Inotify:
+    """
+    Minimal inotify binding with ctypes, watching directories for changes of their entries.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self._dirs = {}
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.fd, selectors.EVENT_READ)
+
+    def watch(self, directory: str) -> None:
+        """
+        Watches directory, does nothing if it is already watched or doesn't exist.
+        """
+        if directory in self._dirs.values():
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def read(self, timeout: float | None) -> list[str]:
+        """
+        Waits up to timeout seconds, forever if None, and returns the paths changed since the last read.
+        A changed entry of a watched directory is returned as its path, a watched directory deleted or moved as itself.
+        """
+        if not self._selector.select(timeout):
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._dirs.get(wd)
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+            elif directory is None:
+                continue
+            elif name:
+                paths.append(os.path.join(directory, os.fsdecode(name)))
+            elif mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                paths.append(directory)
+        return paths
+
+    def close(self) -> None:
+        self._selector.close()
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Keeps a State tree installed: installs it once, then sleeps until inotify reports changes of the watch_paths
+    of its States, and re-applies ensure_installed only to the States affected, once the changes stopped for debounce seconds.
+    The units reconverged are the States of the tree with Chain, Parallel and Graph flattened, e.g. Invert(Apt('x'))
+    is reconverged as a whole when the dpkg status changes. States without watch_paths are only installed once.
+    """
+    def __init__(self, root: State, debounce: float = 2.0, max_delay: float = 30.0, run: Callable[[], Run] = Run):
+        """
+        root: State tree to keep installed
+        debounce: seconds without changes before reconverging
+        max_delay: maximal seconds between the first change and reconverging, even if changes continue
+        run: creates the Run of every reconvergence, each Run detects the affected States again
+        """
+        self.root = root
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.run = run
+        self.units = _units(root)
+        self._paths = {}
+        for unit in self.units:
+            for state in _walk(unit):
+                for path in state.watch_paths():
+                    self._paths.setdefault(os.path.normpath(_expand(path)), []).append(unit)
+        self._inotify = None
+
+    def _sync(self) -> None:
+        """
+        Watches every path that exists and the nearest existing parent of every path, to notice it being created or replaced.
+        """
+        for path in self._paths:
+            if os.path.isdir(path):
+                self._inotify.watch(path)
+            parent = os.path.dirname(path)
+            while parent != os.path.dirname(parent) and not os.path.isdir(parent):
+                parent = os.path.dirname(parent)
+            self._inotify.watch(parent)
+
+    def affected(self, changed: list[str]) -> list[State]:
+        """
+        Returns the units watching a changed path, a path inside it or one of its parents, in install order.
+        """
+        hit = set()
+        for path in map(os.path.normpath, changed):
+            for watched, units in self._paths.items():
+                if path == watched or path.startswith(watched + os.sep) or watched.startswith(path + os.sep):
+                    hit.update(units)
+        return [unit for unit in self.units if unit in hit]
+
+    def _wait(self) -> list[str]:
+        changed = self._inotify.read(None)
+        first = last = time.monotonic()
+        while True:
+            timeout = min(last + self.debounce, first + self.max_delay) - time.monotonic()
+            if timeout <= 0:
+                return changed
+            more = self._inotify.read(timeout)
+            if more:
+                changed += more
+                last = time.monotonic()
+
+    def reconverge(self, units: list[State]) -> None:
+        """
+        Ensures units are installed in a new Run, a failing unit doesn't stop the others.
+        Changes made by reconverging are reported by inotify too, the next call only detects them.
+        """
+        with self.run():
+            for unit in units:
+                try:
+                    if unit.is_installed():
+                        continue
+                    print(f"# drift: {unit!r}")
+                    unit.ensure_installed()
+                except Exception as e:
+                    print(f"{AnsiColor.RED}failed to reconverge {unit!r}: {type(e).__name__}: {e}{AnsiColor.END}")
+
+    def watch(self) -> None:
+        """
+        Installs root and keeps it installed until interrupted.
+        """
+        assert Backend.current().local, "Watcher only watches the local machine"
+        self._inotify = Inotify()
+        try:
+            # watching before installing, so no change between both is missed
+            self._sync()
+            with self.run():
+                self.root.ensure_installed()
+            print(f"# watching {len(self._paths)} paths of {len(self.units)} states")
+            while True:
+                units = self.affected(self._wait())
+                self._sync()
+                if units:
+                    self.reconverge(units)
+        finally:
+            self._inotify.close()
+            self._inotify = None